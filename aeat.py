@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import io
 from logging import getLogger
 from decimal import Decimal
 from datetime import datetime
 from zeep import helpers
 import json
-from collections import namedtuple
-from ast import literal_eval
-
+from collections import Counter
+from functools import lru_cache
+from itertools import islice
+from threading import Lock
+from lxml import etree
+from sql import Cast, Literal, Null, Select, Window
+from sql.conditionals import Case
+from sql.functions import CurrentTimestamp, RowNumber
+
+from trytond import backend
+from trytond.cache import LRUDict
 from trytond.model import ModelSQL, ModelView, fields, Workflow
 from trytond.wizard import Wizard, StateView, StateAction, Button
 from trytond.pyson import Eval, Bool, PYSONEncoder
@@ -17,9 +26,10 @@ from trytond.transaction import Transaction
 from trytond.config import config
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
-from trytond.tools import grouped_slice
+from trytond.tools import grouped_slice, reduce_ids
 from . import tools
 from . import service
+from .aeat_mapping import payload_cache_stats, raise_errors
 
 
 __all__ = [
@@ -38,6 +48,13 @@ _ZERO = Decimal('0.0')
 # AEAT SII test
 SII_TEST = config.getboolean('aeat', 'sii_test', default=True)
 MAX_SII_LINES = config.getint('aeat', 'sii_lines', default=300)
+# Registers of the query responses created at once
+QUERY_CHUNK = config.getint('aeat', 'sii_query_chunk', default=1000)
+
+# Line of each invoice of the requests being sent by the key of its IDFactura,
+# by database and report, so responses can be applied in any order
+_request_indexes = LRUDict(1024)
+_request_indexes_lock = Lock()
 
 def _decimal(x):
     return Decimal(x) if x is not None else None
@@ -50,6 +67,169 @@ def _date(x):
 def _datetime(x):
     return datetime.strptime(x, "%d-%m-%Y %H:%M:%S")
 
+
+@lru_cache(maxsize=None)
+def _path(path):
+    return '{*}' + path.replace('/', '/{*}')
+
+
+def _invoice_key(invoice_id):
+    "Return the key of an IDFactura of a request or a response"
+    issuer = invoice_id['IDEmisorFactura']
+    other = issuer.get('IDOtro')
+    return (issuer.get('NIF') or (other['ID'] if other else None),
+        invoice_id['NumSerieFacturaEmisor'],
+        invoice_id['FechaExpedicionFacturaEmisor'])
+
+
+def _normalize_vat(code):
+    return code.replace(' ', '').replace('-', '').upper() if code else code
+
+
+def _issuer_tax_identifier(values, id_type):
+    "Return the normalized tax identifier of the issuer of a received register"
+    vat = _normalize_vat(values['issuer_vat_number'])
+    if not id_type:
+        if vat and not vat.startswith('ES'):
+            vat = 'ES' + vat
+        return vat
+    elif id_type == '02':
+        return vat
+
+
+def _pair_response_lines(index, response_lines, report=None):
+    '''
+    Yield the line of index of each of the response lines.
+
+    index has the lines of each IDFactura key in the order they were sent,
+    the registers sharing their key are paired in that order.
+    '''
+    for response_line in response_lines:
+        key = _invoice_key(response_line['IDFactura'])
+        lines = index.get(key)
+        if not lines:
+            _logger.warning('Report %s has no line for %s', report, key)
+            continue
+        if len(lines) > 1:
+            _logger.warning('Report %s has %s lines for %s', report,
+                len(lines), key)
+            # The last one is kept for responses sent again
+            line = lines.pop(0)
+        else:
+            line = lines[0]
+        yield line, response_line
+
+
+def _copy_value(value):
+    "Return value in the text format of PostgreSQL COPY"
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+        .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _text(element, path):
+    return element.findtext(_path(path)) if element is not None else None
+
+
+def _find(element, path):
+    return element.find(_path(path)) if element is not None else None
+
+
+def _register_values(reg, data):
+    "Return the report line values common to issued and received registers"
+    id_factura = _find(reg, 'IDFactura')
+    counterpart = _find(reg, data + '/Contraparte')
+    return {
+        'state': _text(reg, 'EstadoFactura/EstadoRegistro'),
+        'last_modify_date': _datetime(
+            _text(reg, 'EstadoFactura/TimestampUltimaModificacion')),
+        'communication_code': _text(reg, 'EstadoFactura/CodigoErrorRegistro'),
+        'communication_msg': _text(reg,
+            'EstadoFactura/DescripcionErrorRegistro'),
+        'issuer_vat_number': (
+            _text(id_factura, 'IDEmisorFactura/NIF') or
+            _text(id_factura, 'IDEmisorFactura/IDOtro/ID')),
+        'serial_number': _text(id_factura, 'NumSerieFacturaEmisor'),
+        'final_serial_number': _text(id_factura,
+            'NumSerieFacturaEmisorResumenFin'),
+        'issue_date': _date(_text(id_factura,
+                'FechaExpedicionFacturaEmisor')),
+        'invoice_kind': _text(reg, data + '/TipoFactura'),
+        'special_key': _text(reg,
+            data + '/ClaveRegimenEspecialOTrascendencia'),
+        'total_amount': _decimal(_text(reg, data + '/ImporteTotal')),
+        'counterpart_name': _text(counterpart, 'NombreRazon'),
+        'counterpart_id': (
+            (_text(counterpart, 'NIF') or _text(counterpart, 'IDOtro/ID'))
+            if counterpart is not None else None),
+        'presenter': _text(reg, 'DatosPresentacion/NIFPresentador'),
+        'presentation_date': _datetime(
+            _text(reg, 'DatosPresentacion/TimestampPresentacion')),
+        'csv': _text(reg, 'DatosPresentacion/CSV'),
+        'balance_state': _text(reg, 'EstadoCuadre/EstadoCuadre'),
+        'aeat_register': etree.tostring(reg, encoding='unicode'),
+        }
+
+
+def _issued_register(reg):
+    "Return the report line values of an issued invoice register"
+    values = _register_values(reg, 'DatosFacturaEmitida')
+    breakdown = _find(reg, 'DatosFacturaEmitida/TipoDesglose')
+    subject = (_find(breakdown, 'DesgloseFactura/Sujeta')
+        if _find(breakdown, 'DesgloseFactura') is not None
+        else (_find(breakdown, 'DesgloseTipoOperacion/PrestacionServicios/'
+                'Sujeta')
+            if _find(breakdown, 'DesgloseTipoOperacion/PrestacionServicios')
+            is not None
+            else _find(breakdown, 'DesgloseTipoOperacion/Entrega/Sujeta')))
+    taxes = []
+    exemption = ''
+    if _find(subject, 'NoExenta') is not None:
+        for detail in subject.iterfind(_path('NoExenta/DesgloseIVA/'
+                    'DetalleIVA')):
+            taxes.append({
+                    'base': _decimal(_text(detail, 'BaseImponible')),
+                    'rate': _decimal(_text(detail, 'TipoImpositivo')),
+                    'amount': _decimal(_text(detail, 'CuotaRepercutida')),
+                    'surcharge_rate': _decimal(
+                        _text(detail, 'TipoRecargoEquivalencia')),
+                    'surcharge_amount': _decimal(
+                        _text(detail, 'CuotaRecargoEquivalencia')),
+                    })
+    elif _find(subject, 'Exenta') is not None:
+        exemption = _text(subject, 'Exenta/DetalleExenta/CausaExencion')
+        for exempt in EXEMPTION_CAUSE:
+            if exempt[0] == exemption:
+                exemption = exempt[1]
+                break
+    values['taxes'] = [('create', taxes)] if taxes else []
+    values['exemption_cause'] = exemption
+    return values
+
+
+def _received_register(reg):
+    "Return the report line values of a received invoice register"
+    values = _register_values(reg, 'DatosFacturaRecibida')
+    taxes = []
+    for detail in reg.iterfind(_path('DatosFacturaRecibida/DesgloseFactura/'
+                'DesgloseIVA/DetalleIVA')):
+        taxes.append({
+                'base': _decimal(_text(detail, 'BaseImponible')),
+                'rate': _decimal(_text(detail, 'TipoImpositivo')),
+                'amount': _decimal(_text(detail, 'CuotaSoportada')),
+                'surcharge_rate': _decimal(
+                    _text(detail, 'TipoRecargoEquivalencia')),
+                'surcharge_amount': _decimal(
+                    _text(detail, 'CuotaRecargoEquivalencia')),
+                'reagyp_rate': _decimal(
+                    _text(detail, 'PorcentCompensacionREAGYP')),
+                'reagyp_amount': _decimal(
+                    _text(detail, 'ImporteCompensacionREAGYP')),
+                })
+    values['taxes'] = [('create', taxes)]
+    return values, _text(reg, 'IDFactura/IDEmisorFactura/IDOtro/IDType')
+
 COMMUNICATION_TYPE = [   # L0
     (None, ''),
     ('A0', 'Registration of invoices/records'),
@@ -269,6 +449,23 @@ class SIIReport(Workflow, ModelSQL, ModelView):
     communication_state = fields.Selection(AEAT_COMMUNICATION_STATE,
         'Communication State', readonly=True)
     csv = fields.Char('CSV', readonly=True)
+    matched_invoices = fields.Integer('Matched Invoices', readonly=True,
+        states={
+            'invisible': ((Eval('operation_type') != 'C0')
+                | (Eval('book') != 'R')),
+            }, depends=['operation_type', 'book'])
+    ambiguous_invoices = fields.Integer('Ambiguous Invoices', readonly=True,
+        states={
+            'invisible': ((Eval('operation_type') != 'C0')
+                | (Eval('book') != 'R')),
+            }, depends=['operation_type', 'book'],
+        help='Registers of the query matching several invoices.')
+    missing_invoices = fields.Integer('Missing Invoices', readonly=True,
+        states={
+            'invisible': ((Eval('operation_type') != 'C0')
+                | (Eval('book') != 'R')),
+            }, depends=['operation_type', 'book'],
+        help='Registers of the query not matching any invoice.')
     version = fields.Selection([
             ('0.7', '0.7'),
             ('1.0', '1.0'),
@@ -415,6 +612,14 @@ class SIIReport(Workflow, ModelSQL, ModelView):
         pool = Pool()
         Invoice = pool.get('account.invoice')
 
+        # The invoices are deleted before they are registered again
+        reports = sorted(reports, key=lambda r: r.operation_type != 'D0')
+        if service.SEND_WORKERS > 1:
+            cls._send_concurrently([r for r in reports
+                    if r.state == 'confirmed' and not r.response
+                    and r.book in {'E', 'R'}
+                    and r.operation_type in {'A0', 'A1', 'D0'}])
+
         for report in reports:
             if report.state != 'confirmed':
                 continue
@@ -439,23 +644,148 @@ class SIIReport(Workflow, ModelSQL, ModelView):
             else:
                 raise NotImplementedError
 
-        to_save = []
+        # The last line of an invoice sets its values
+        values = {}
         for report in reports:
             if report.operation_type == 'C0':
                 continue
             for line in report.lines:
-                invoice = line.invoice
-                if invoice:
-                    invoice.sii_communication_type = report.operation_type
-                    invoice.sii_state = line.state
-
-                    to_save.append(invoice)
-
-        Invoice.save(to_save)
+                if line.invoice:
+                    values[line.invoice] = (report.operation_type, line.state)
+        # Invoices to update by their new values
+        to_update = {}
+        for invoice, invoice_values in values.items():
+            to_update.setdefault(invoice_values, []).append(invoice)
+        to_write = []
+        for (operation_type, state), invoices in to_update.items():
+            to_write.extend((invoices, {
+                        'sii_communication_type': operation_type,
+                        'sii_state': state,
+                        }))
+        if to_write:
+            Invoice.write(*to_write)
         cls.write(reports, {
             'send_date': datetime.now(),
             })
-        _logger.debug('Done sending reports to AEAT SII')
+        _logger.debug('Done sending reports to AEAT SII, sessions: %s, '
+            'requests cache: %s', service.session_stats(),
+            payload_cache_stats())
+
+    @classmethod
+    def _send_concurrently(cls, reports):
+        '''
+        Send the reports to AEAT in parallel and store their responses so
+        the submit and delete methods only have to apply them.
+
+        The reports are sent in waves where no two reports share an invoice,
+        each wave once the previous one is answered, so the deletion of an
+        invoice always reaches AEAT before it is registered again.
+        '''
+        if len(reports) < 2:
+            return
+        bodies = cls._build_submit_requests(
+            [r for r in reports if r.operation_type != 'D0'])
+        for wave in cls._send_waves(reports):
+            cls._send_wave(wave, bodies)
+
+    @staticmethod
+    def _send_waves(reports):
+        '''
+        Return the reports split in waves to send one after the other.
+
+        A report is sent in the wave following the last one with any of its
+        invoices, so the D0 reports must come before the A0 and A1 ones.
+        '''
+        waves = []
+        # Last wave of each invoice
+        invoice_waves = {}
+        for report in reports:
+            invoices = {l.invoice.id for l in report.lines if l.invoice}
+            index = max((invoice_waves[i] + 1 for i in invoices
+                    if i in invoice_waves), default=0)
+            if index == len(waves):
+                waves.append([])
+            waves[index].append(report)
+            for invoice in invoices:
+                invoice_waves[invoice] = index
+        return waves
+
+    @classmethod
+    def _send_wave(cls, reports, bodies):
+        calls = []
+        for report in reports:
+            srv = report._bind_sii_service()
+            headers = report._get_sii_headers()
+            if report.operation_type == 'D0':
+                body = [tools.loads_header(line.sii_header)
+                    for line in report.lines]
+                calls.append((srv, 'cancel', (headers, body)))
+            else:
+                body = bodies[report]
+                calls.append((srv, 'submit_request', (headers, body)))
+            report._index_request(body)
+
+        _logger.info('Sending %s reports to AEAT SII with %s workers',
+            len(reports), service.SEND_WORKERS)
+        error = None
+        for report, (result, exception) in zip(reports,
+                service.call_concurrently(calls)):
+            if exception is not None:
+                _logger.warning('Error sending report %s to AEAT SII: %s',
+                    report.id, exception)
+                error = error or exception
+                continue
+            if report.operation_type != 'D0':
+                result, request = result
+                report.aeat_register = request.decode('utf-8')
+            report.response = json.dumps(helpers.serialize_object(result))
+            report.save()
+        Transaction().commit()
+        # The next waves may depend on the reports that failed
+        if error is not None:
+            raise UserError(gettext('aeat_sii.msg_service_message',
+                message=tools.unaccent(str(error))))
+
+    @classmethod
+    def _build_submit_requests(cls, reports):
+        '''
+        Return the submit requests of the invoices of each report.
+
+        The invoices of all the reports of a book are mapped in a single batch
+        so their related records are read once and large backlogs can be
+        mapped by several processes.
+        '''
+        pool = Pool()
+        IssuedMapper = pool.get('aeat.sii.issued.invoice.mapper')
+        ReceivedMapper = pool.get('aeat.sii.recieved.invoice.mapper')
+
+        requests = {}
+        for book, Mapper in [('E', IssuedMapper), ('R', ReceivedMapper)]:
+            book_reports = [r for r in reports if r.book == book]
+            if not book_reports:
+                continue
+            invoices = [l.invoice for r in book_reports for l in r.lines]
+            book_requests, errors = Mapper().build_submit_requests(invoices)
+            raise_errors(errors)
+            book_requests = iter(book_requests)
+            for report in book_reports:
+                requests[report] = list(islice(book_requests,
+                        len(report.lines)))
+        return requests
+
+    def _bind_sii_service(self):
+        if self.book == 'E':
+            bind = service.bind_issued_invoices_service
+        else:
+            bind = service.bind_recieved_invoices_service
+        return bind(*self.company.get_sii_ssl_context(), test=SII_TEST)
+
+    def _get_sii_headers(self):
+        return tools.get_headers(
+            name=tools.unaccent(self.company.party.name),
+            vat=self.company_vat,
+            comm_kind=self.operation_type,
+            version=self.version)
 
     @classmethod
     @ModelView.button
@@ -463,7 +793,7 @@ class SIIReport(Workflow, ModelSQL, ModelView):
     def process_response(cls, reports):
         for report in reports:
             if report.response:
-                cls._save_response(report.response)
+                report._save_response(report.response)
                 report.save()
 
     @classmethod
@@ -472,6 +802,7 @@ class SIIReport(Workflow, ModelSQL, ModelView):
         pool = Pool()
         Invoice = pool.get('account.invoice')
         ReportLine = pool.get('aeat.sii.report.lines')
+        line = ReportLine.__table__()
 
         to_create = []
         for report in reports:
@@ -479,6 +810,10 @@ class SIIReport(Workflow, ModelSQL, ModelView):
                 ('sii_book_key', '=', report.book),
                 ('move.period', '=', report.period.id),
                 ('state', 'in', ['posted', 'paid']),
+                # Skip the invoices already in the report
+                ('id', 'not in', line.select(line.invoice,
+                        where=(line.report == report.id)
+                        & (line.invoice != Null))),
             ]
 
             if report.operation_type == 'A0':
@@ -499,18 +834,18 @@ class SIIReport(Workflow, ModelSQL, ModelView):
             _logger.debug('Searching invoices for SII report: %s', domain)
 
             for invoice in Invoice.search(domain):
-                if not all(l.report != report for l in invoice.sii_records):
-                    continue
                 to_create.append({
-                    'report': report,
-                    'invoice': invoice,
+                    'report': report.id,
+                    'invoice': invoice.id,
+                    'company': report.company.id,
                     })
 
+        # The headers of all the lines are built by create in a batch
         if to_create:
             ReportLine.create(to_create)
 
     def submit_issued_invoices(self):
-        if self.state != 'confirmed':
+        if self.state != 'confirmed' or self.response:
             _logger.info('This report %s has already been sended', self.id)
         else:
             _logger.info('Sending report %s to AEAT SII', self.id)
@@ -520,14 +855,15 @@ class SIIReport(Workflow, ModelSQL, ModelView):
                 comm_kind=self.operation_type,
                 version=self.version)
 
-            with self.company.tmp_ssl_credentials() as (crt, key):
-                srv = service.bind_issued_invoices_service(
-                    crt, key, test=SII_TEST)
-                try:
-                    res, request = srv.submit(headers, (l.invoice for l in self.lines))
-                    self.aeat_register = request
-                except Exception as e:
-                    raise UserError(tools.unaccent(str(e)))
+            srv = self._bind_sii_service()
+            try:
+                body = srv.build_submit_request(
+                    [l.invoice for l in self.lines])
+                self._index_request(body)
+                res, request = srv.submit_request(headers, body)
+                self.aeat_register = request.decode('utf-8')
+            except Exception as e:
+                raise UserError(tools.unaccent(str(e)))
 
             if not self.response:
                 self.state == 'sending'
@@ -537,7 +873,7 @@ class SIIReport(Workflow, ModelSQL, ModelView):
         self._save_response(self.response)
 
     def delete_issued_invoices(self):
-        if self.state != 'confirmed':
+        if self.state != 'confirmed' or self.response:
             _logger.info('This report %s has already been sended', self.id)
         else:
             _logger.info('Deleting report %s from AEAT SII', self.id)
@@ -547,15 +883,15 @@ class SIIReport(Workflow, ModelSQL, ModelView):
                 comm_kind=self.operation_type,
                 version=self.version)
 
-            with self.company.tmp_ssl_credentials() as (crt, key):
-                srv = service.bind_issued_invoices_service(
-                    crt, key, test=SII_TEST)
-                try:
-                    res = srv.cancel(
-                        headers, [eval(line.sii_header) for line in self.lines])
-                except Exception as e:
-                    raise UserError(gettext('aeat_sii.msg_service_message',
-                        message=tools.unaccent(str(e))))
+            srv = self._bind_sii_service()
+            try:
+                body = [tools.loads_header(line.sii_header)
+                    for line in self.lines]
+                self._index_request(body)
+                res = srv.cancel(headers, body)
+            except Exception as e:
+                raise UserError(gettext('aeat_sii.msg_service_message',
+                    message=tools.unaccent(str(e))))
 
             if not self.response:
                 self.state == 'sending'
@@ -568,7 +904,6 @@ class SIIReport(Workflow, ModelSQL, ModelView):
         pool = Pool()
         Invoice = pool.get('account.invoice')
         SIIReportLine = pool.get('aeat.sii.report.lines')
-        SIIReportLineTax = pool.get('aeat.sii.report.line.tax')
 
         headers = tools.get_headers(
             name=tools.unaccent(self.company.party.name),
@@ -576,110 +911,40 @@ class SIIReport(Workflow, ModelSQL, ModelView):
             comm_kind=self.operation_type,
             version=self.version)
 
-        with self.company.tmp_ssl_credentials() as (crt, key):
-            srv = service.bind_issued_invoices_service(
-                crt, key, test=SII_TEST)
-            res = srv.query(
+        pagination = 'S'
+        while pagination == 'S':
+            srv = self._bind_sii_service()
+            res = srv.query_stream(
                 headers,
                 year=self.period.start_date.year,
                 period=self.period.start_date.month,
                 last_invoice=last_invoice)
 
-        registers = res.RegistroRespuestaConsultaLRFacturasEmitidas
-        # FIXME: the number can be repeated over time
-        invoices_list = Invoice.search([
-                ('number', 'in', [
-                    reg.IDFactura.NumSerieFacturaEmisor
-                    for reg in registers
-                    ]),
-                ('move', '!=', None),
-                ])
-        invoices_ids = {
-            invoice.number: invoice.id
-            for invoice in invoices_list
-        }
-        pagination = res.IndicadorPaginacion
-        last_invoice = registers and registers[-1].IDFactura
-        lines_to_create = []
-        for reg in registers:
-            taxes_to_create = []
-            taxes = None
-            exemption = ''
-            tipo_desglose = reg.DatosFacturaEmitida.TipoDesglose
-            if tipo_desglose.DesgloseFactura:
-                sujeta = tipo_desglose.DesgloseFactura.Sujeta
-            else:
-                if tipo_desglose.DesgloseTipoOperacion.PrestacionServicios:
-                    sujeta = tipo_desglose.DesgloseTipoOperacion.\
-                        PrestacionServicios.Sujeta
-                else:
-                    sujeta = tipo_desglose.DesgloseTipoOperacion.Entrega.Sujeta
-
-            if sujeta.NoExenta:
-                for detail in sujeta.NoExenta.DesgloseIVA.DetalleIVA:
-                    taxes_to_create.append({
-                            'base': _decimal(detail.BaseImponible),
-                            'rate': _decimal(detail.TipoImpositivo),
-                            'amount': _decimal(detail.CuotaRepercutida),
-                            'surcharge_rate': _decimal(
-                                detail.TipoRecargoEquivalencia),
-                            'surcharge_amount': _decimal(
-                                detail.CuotaRecargoEquivalencia),
-                            })
-                taxes = SIIReportLineTax.create(taxes_to_create)
-            elif sujeta.Exenta:
-                exemption = sujeta.Exenta.DetalleExenta[0].CausaExencion
-                for exempt in EXEMPTION_CAUSE:
-                    if exempt[0] == exemption:
-                        exemption = exempt[1]
-                        break
-
-            sii_report_line = {
-                'report': self.id,
-                'invoice': invoices_ids.get(
-                    reg.IDFactura.NumSerieFacturaEmisor),
-                'state': reg.EstadoFactura.EstadoRegistro,
-                'last_modify_date': _datetime(
-                    reg.EstadoFactura.TimestampUltimaModificacion),
-                'communication_code': reg.EstadoFactura.CodigoErrorRegistro,
-                'communication_msg': reg.EstadoFactura.DescripcionErrorRegistro,
-                'issuer_vat_number': (
-                    reg.IDFactura.IDEmisorFactura.NIF or
-                    reg.IDFactura.IDEmisorFactura.IDOtro.ID),
-                'serial_number': reg.IDFactura.NumSerieFacturaEmisor,
-                'final_serial_number': (
-                    reg.IDFactura.NumSerieFacturaEmisorResumenFin),
-                'issue_date': _date(
-                    reg.IDFactura.FechaExpedicionFacturaEmisor),
-                'invoice_kind': reg.DatosFacturaEmitida.TipoFactura,
-                'special_key': (
-                    reg.DatosFacturaEmitida.ClaveRegimenEspecialOTrascendencia),
-                'total_amount': _decimal(reg.DatosFacturaEmitida.ImporteTotal),
-                'taxes': [('add', [t.id for t in taxes])] if taxes else [],
-                'exemption_cause': exemption,
-                'counterpart_name': (
-                    reg.DatosFacturaEmitida.Contraparte.NombreRazon
-                    if reg.DatosFacturaEmitida.Contraparte else None),
-                'counterpart_id': (
-                    (
-                        reg.DatosFacturaEmitida.Contraparte.NIF or
-                        reg.DatosFacturaEmitida.Contraparte.IDOtro.ID)
-                    if reg.DatosFacturaEmitida.Contraparte else None),
-                'presenter': reg.DatosPresentacion.NIFPresentador,
-                'presentation_date': _datetime(
-                    reg.DatosPresentacion.TimestampPresentacion),
-                'csv': reg.DatosPresentacion.CSV,
-                'balance_state': reg.DatosPresentacion.CSV,
-                'aeat_register': str(reg),
-                }
-            lines_to_create.append(sii_report_line)
-        SIIReportLine.create(lines_to_create)
-
-        if pagination == 'S':
-            self.query_issued_invoices(last_invoice=last_invoice)
+            registers = iter(res)
+            while True:
+                lines_to_create = [_issued_register(reg)
+                    for reg in islice(registers, QUERY_CHUNK)]
+                if not lines_to_create:
+                    break
+                # FIXME: the number can be repeated over time
+                invoices_ids = {
+                    invoice.number: invoice.id
+                    for invoice in Invoice.search([
+                            ('number', 'in', [
+                                    line['serial_number']
+                                    for line in lines_to_create
+                                    ]),
+                            ('move', '!=', None),
+                            ])
+                    }
+                for line in lines_to_create:
+                    line['report'] = self.id
+                    line['invoice'] = invoices_ids.get(line['serial_number'])
+                SIIReportLine.create(lines_to_create)
+            pagination, last_invoice = res.pagination, res.last_invoice
 
     def submit_recieved_invoices(self):
-        if self.state != 'confirmed':
+        if self.state != 'confirmed' or self.response:
             _logger.info('This report %s has already been sended', self.id)
         else:
             _logger.info('Sending report %s to AEAT SII', self.id)
@@ -689,15 +954,16 @@ class SIIReport(Workflow, ModelSQL, ModelView):
                 comm_kind=self.operation_type,
                 version=self.version)
 
-            with self.company.tmp_ssl_credentials() as (crt, key):
-                srv = service.bind_recieved_invoices_service(
-                    crt, key, test=SII_TEST)
-                try:
-                    res, request = srv.submit(headers, (l.invoice for l in self.lines))
-                    self.aeat_register = request
-                except Exception as e:
-                    raise UserError(gettext('aeat_sii.msg_service_message',
-                        message=tools.unaccent(str(e))))
+            srv = self._bind_sii_service()
+            try:
+                body = srv.build_submit_request(
+                    [l.invoice for l in self.lines])
+                self._index_request(body)
+                res, request = srv.submit_request(headers, body)
+                self.aeat_register = request.decode('utf-8')
+            except Exception as e:
+                raise UserError(gettext('aeat_sii.msg_service_message',
+                    message=tools.unaccent(str(e))))
 
             if not self.response:
                 self.state == 'sending'
@@ -707,7 +973,7 @@ class SIIReport(Workflow, ModelSQL, ModelView):
         self._save_response(self.response)
 
     def delete_recieved_invoices(self):
-        if self.state != 'confirmed':
+        if self.state != 'confirmed' or self.response:
             _logger.info('This report %s has already been sended', self.id)
         else:
             _logger.info('Deleting report %s from AEAT SII', self.id)
@@ -717,15 +983,15 @@ class SIIReport(Workflow, ModelSQL, ModelView):
                 comm_kind=self.operation_type,
                 version=self.version)
 
-            with self.company.tmp_ssl_credentials() as (crt, key):
-                try:
-                    srv = service.bind_recieved_invoices_service(
-                        crt, key, test=SII_TEST)
-                    res = srv.cancel(
-                        headers, [eval(line.sii_header) for line in self.lines])
-                except Exception as e:
-                    raise UserError(gettext('aeat_sii.msg_service_message',
-                        message=tools.unaccent(str(e))))
+            try:
+                srv = self._bind_sii_service()
+                body = [tools.loads_header(line.sii_header)
+                    for line in self.lines]
+                self._index_request(body)
+                res = srv.cancel(headers, body)
+            except Exception as e:
+                raise UserError(gettext('aeat_sii.msg_service_message',
+                    message=tools.unaccent(str(e))))
 
             if not self.response:
                 self.state == 'sending'
@@ -734,30 +1000,82 @@ class SIIReport(Workflow, ModelSQL, ModelView):
                 Transaction().commit()
         self._save_response(self.response)
 
+    def _index_request(self, body):
+        "Keep the lines of each register of the request body"
+        index = {}
+        for line, register in zip(self.lines, body):
+            index.setdefault(_invoice_key(register['IDFactura']), []).append(
+                line.id)
+        with _request_indexes_lock:
+            _request_indexes[(Transaction().database.name, self.id)] = index
+
+    def _get_request_index(self):
+        '''
+        Return the lines of the report by the key of the IDFactura they were
+        sent with.
+
+        The index kept when the request was built is used and otherwise, for
+        example once the worker was restarted, the one of the stored headers.
+        '''
+        with _request_indexes_lock:
+            index = _request_indexes.pop(
+                (Transaction().database.name, self.id), None)
+        if index is not None:
+            lines = {l.id: l for l in self.lines}
+            return {k: [lines[i] for i in ids if i in lines]
+                for k, ids in index.items()}
+        index = {}
+        for line in self.lines:
+            header = tools.loads_header(line.sii_header)
+            if header:
+                index.setdefault(_invoice_key(header['IDFactura']), []).append(
+                    line)
+        return index
+
+    def _apply_response_lines(self, index, response_lines):
+        '''
+        Store the state of the registers of the response lines on the lines
+        of index, the response lines can be any part of the request in any
+        order.
+        '''
+        pool = Pool()
+        SIIReportLine = pool.get('aeat.sii.report.lines')
+
+        # Lines to update by their new values
+        to_update = {}
+        for line, response_line in _pair_response_lines(index,
+                response_lines, self.id):
+            if line.communication_code:
+                continue
+            values = (response_line['EstadoRegistro'],
+                response_line['CodigoErrorRegistro'],
+                response_line['DescripcionErrorRegistro'])
+            to_update.setdefault(values, []).append(line)
+        to_write = []
+        for (state, code, msg), lines in to_update.items():
+            to_write.extend((lines, {
+                        'state': state,
+                        'communication_code': code,
+                        'communication_msg': msg,
+                        }))
+        if to_write:
+            SIIReportLine.write(*to_write)
+
     def _save_response(self, res):
         if res:
-            response = json.loads(res, object_hook=lambda d: namedtuple(
-                    'SII', d.keys())(*d.values()))
-            for (report_line, response_line) in zip(
-                    self.lines, response.RespuestaLinea):
-                if not report_line.communication_code:
-                    report_line.state = response_line.EstadoRegistro
-                    report_line.communication_code = response_line.CodigoErrorRegistro
-                    report_line.communication_msg = (
-                        response_line.DescripcionErrorRegistro)
-                    report_line.save()
+            response = json.loads(res)
+            self._apply_response_lines(self._get_request_index(),
+                response['RespuestaLinea'] or [])
             if not self.communication_state:
-                self.communication_state = response.EstadoEnvio
+                self.communication_state = response['EstadoEnvio']
             if not self.csv:
-                self.csv = response.CSV
+                self.csv = response['CSV']
             self.response = ''
             self.save()
 
     def query_recieved_invoices(self, last_invoice=None):
         pool = Pool()
-        Invoice = pool.get('account.invoice')
         SIIReportLine = pool.get('aeat.sii.report.lines')
-        SIIReportLineTax = pool.get('aeat.sii.report.line.tax')
 
         headers = tools.get_headers(
             name=tools.unaccent(self.company.party.name),
@@ -765,311 +1083,244 @@ class SIIReport(Workflow, ModelSQL, ModelView):
             comm_kind=self.operation_type,
             version=self.version)
 
-        with self.company.tmp_ssl_credentials() as (crt, key):
-            srv = service.bind_recieved_invoices_service(
-                crt, key, test=SII_TEST)
-            res = srv.query(
+        stats = Counter()
+        pagination = 'S'
+        while pagination == 'S':
+            srv = self._bind_sii_service()
+            res = srv.query_stream(
                 headers,
                 year=self.period.start_date.year,
                 period=self.period.start_date.month,
                 last_invoice=last_invoice)
 
-        _logger.debug(res)
-        registers = res.RegistroRespuestaConsultaLRFacturasRecibidas
-        pagination = res.IndicadorPaginacion
-        last_invoice = registers[-1].IDFactura
-
-        # FIXME: the reference is not forced to be unique
-        lines_to_create = []
-        for reg in registers:
-            invoice_date = _date(reg.IDFactura.FechaExpedicionFacturaEmisor)
-
-            taxes_to_create = []
-            for detail in reg.DatosFacturaRecibida.DesgloseFactura.DesgloseIVA.\
-                    DetalleIVA:
-                taxes_to_create.append({
-                        'base': _decimal(detail.BaseImponible),
-                        'rate': _decimal(detail.TipoImpositivo),
-                        'amount': _decimal(detail.CuotaSoportada),
-                        'surcharge_rate': _decimal(
-                            detail.TipoRecargoEquivalencia),
-                        'surcharge_amount': _decimal(
-                            detail.CuotaRecargoEquivalencia),
-                        'reagyp_rate': _decimal(
-                            detail.PorcentCompensacionREAGYP),
-                        'reagyp_amount': _decimal(
-                            detail.ImporteCompensacionREAGYP),
-                        })
-            taxes = SIIReportLineTax.create(taxes_to_create)
-
-            sii_report_line = {
-                'report': self.id,
-                'state': reg.EstadoFactura.EstadoRegistro,
-                'last_modify_date': _datetime(
-                    reg.EstadoFactura.TimestampUltimaModificacion),
-                'communication_code': (
-                    reg.EstadoFactura.CodigoErrorRegistro),
-                'communication_msg': (
-                    reg.EstadoFactura.DescripcionErrorRegistro),
-                'issuer_vat_number': (
-                    reg.IDFactura.IDEmisorFactura.NIF or
-                    reg.IDFactura.IDEmisorFactura.IDOtro.ID),
-                'serial_number': reg.IDFactura.NumSerieFacturaEmisor,
-                'final_serial_number': (
-                    reg.IDFactura.NumSerieFacturaEmisorResumenFin),
-                'issue_date': invoice_date,
-                'invoice_kind': reg.DatosFacturaRecibida.TipoFactura,
-                'special_key': (reg.DatosFacturaRecibida.
-                    ClaveRegimenEspecialOTrascendencia),
-                'total_amount': _decimal(
-                    reg.DatosFacturaRecibida.ImporteTotal),
-                'taxes': [('add', [t.id for t in taxes])],
-                'counterpart_name': (
-                    reg.DatosFacturaRecibida.Contraparte.NombreRazon),
-                'counterpart_id': (
-                    reg.DatosFacturaRecibida.Contraparte.NIF or
-                    reg.DatosFacturaRecibida.Contraparte.IDOtro.ID),
-                'presenter': reg.DatosPresentacion.NIFPresentador,
-                'presentation_date': _datetime(
-                    reg.DatosPresentacion.TimestampPresentacion),
-                'csv': reg.DatosPresentacion.CSV,
-                'balance_state': reg.DatosPresentacion.CSV,
-                'aeat_register': str(reg),
-                }
-
-            domain = [
-                ('reference', '=', reg.IDFactura.NumSerieFacturaEmisor),
-                ('invoice_date', '=', invoice_date),
-                ('move', '!=', None),
-                ]
-            vat = True
-            if reg.IDFactura.IDEmisorFactura.NIF:
-                vat = reg.IDFactura.IDEmisorFactura.NIF
-                if not vat.startswith('ES'):
-                    vat = 'ES' + vat
-                domain.append(
-                    ('party.tax_identifier', '=', vat)
-                    )
-            elif reg.IDFactura.IDEmisorFactura.IDOtro.IDType == '02':
-                domain.append(
-                    ('party.tax_identifier', '=',
-                        reg.IDFactura.IDEmisorFactura.IDOtro.ID)
-                    )
-            else:
-                vat = False
-            invoices = Invoice.search(domain)
-            if not vat and len(invoices) > 1:
-                invoice_ok = []
-                for invoice in invoices:
-                    for register in registers:
-                        if register == reg.IDFactura.IDEmisorFactura.IDOtro.ID:
-                            invoice_ok.append(invoice)
-                            break
-                    invoices = invoice_ok
-                    if invoice_ok:
-                        break
-            if invoices:
-                sii_report_line['invoice'] = invoices[0].id
-            lines_to_create.append(sii_report_line)
-        SIIReportLine.create(lines_to_create)
-
-        if pagination == 'S':
-            self.query_recieved_invoices(last_invoice=last_invoice)
+            registers = iter(res)
+            while True:
+                chunk = [_received_register(reg)
+                    for reg in islice(registers, QUERY_CHUNK)]
+                if not chunk:
+                    break
+                invoices, chunk_stats = self._match_received_invoices(chunk)
+                stats.update(chunk_stats)
+                lines_to_create = []
+                for (sii_report_line, _), invoice in zip(chunk, invoices):
+                    sii_report_line['report'] = self.id
+                    sii_report_line['invoice'] = invoice
+                    lines_to_create.append(sii_report_line)
+                SIIReportLine.create(lines_to_create)
+            pagination, last_invoice = res.pagination, res.last_invoice
+
+        _logger.info('Report %s matched %s received invoices, %s ambiguous '
+            'and %s missing', self.id, stats['matched'], stats['ambiguous'],
+            stats['missing'])
+        self.matched_invoices = stats['matched']
+        self.ambiguous_invoices = stats['ambiguous']
+        self.missing_invoices = stats['missing']
+        self.save()
 
-    @classmethod
-    def get_issued_sii_reports(cls):
+    @staticmethod
+    def _match_received_invoices(registers):
+        '''
+        Return the invoice id of each of the registers, pairs of report line
+        values and IDType, and a counter of the matched, ambiguous and missing
+        ones.
+
+        The candidates of all the registers are read by a single search and
+        indexed by reference, date and tax identifier of their party. The
+        registers without a tax identifier are matched by reference and date
+        only. A register matching several invoices is not linked to any.
+        '''
         pool = Pool()
         Invoice = pool.get('account.invoice')
-        SIIReportLine = pool.get('aeat.sii.report.lines')
-
-        issued_invoices = {
-            'A0': {}, # 'A0', 'Registration of invoices/records'
-            'A1': {}, # 'A1', 'Amendment of invoices/records (registration errors)'
-            'D0': {}, # 'D0', 'Delete Invoices'
-        }
-
-        issued_invs = Invoice.search([
-                ('sii_pending_sending', '=', True),
-                ('sii_state', '=', 'Correcto'),
-                ('sii_header', '!=', None),
-                ('type', '=', 'out'),
-                ])
-
-        # search issued invoices [delete]
-        delete_issued_invoices = []
-        # search issued invoices [modify]
-        modify_issued_invoices = []
-        for issued_inv in issued_invs:
-            if not issued_inv.sii_records:
-                continue
-            sii_record_id = max([s.id for s in issued_inv.sii_records])
-            sii_record = SIIReportLine(sii_record_id)
-            if issued_inv.sii_header:
-                if (literal_eval(issued_inv.sii_header) ==
-                        literal_eval(sii_record.sii_header)):
-                    modify_issued_invoices.append(issued_inv)
-                else:
-                    delete_issued_invoices.append(issued_inv)
 
-        periods = {}
-        for invoice in delete_issued_invoices:
-            period = invoice.move.period
-            if period in periods:
-                periods[period].append(invoice,)
-            else:
-                periods[period] = [invoice]
-        issued_invoices['D0'] = periods
-
-        periods2 = {}
-        for invoice in modify_issued_invoices:
-            period = invoice.move.period
-            if period in periods2:
-                periods2[period].append(invoice,)
-            else:
-                periods2[period] = [invoice]
-        issued_invoices['A1'] = periods2
-
-        # search issued invoices [new]
-        new_issued_invoices = Invoice.search([
-                ('sii_state', 'in', (None, 'Incorrecto', 'Anulada')),
-                ('sii_pending_sending', '=', True),
-                ('type', '=', 'out'),
+        # FIXME: the reference is not forced to be unique
+        invoices = Invoice.search([
+                ('reference', 'in', list({
+                            v['serial_number'] for v, _ in registers})),
+                ('invoice_date', 'in', list({
+                            v['issue_date'] for v, _ in registers})),
                 ('move', '!=', None),
-                ])
-
-        new_issued_invoices += delete_issued_invoices
-
-        periods1 = {}
-        for invoice in new_issued_invoices:
-            period = invoice.move.period
-            if period in periods1:
-                periods1[period].append(invoice,)
+                ], order=[('id', 'ASC')])
+        tools.prefetch(invoices, ['party.identifiers'])
+        by_issuer, by_date = {}, {}
+        for invoice in invoices:
+            key = (invoice.reference, invoice.invoice_date)
+            by_date.setdefault(key, []).append(invoice.id)
+            identifier = invoice.party.tax_identifier
+            if identifier:
+                by_issuer.setdefault(
+                    key + (_normalize_vat(identifier.code),), []).append(
+                    invoice.id)
+
+        result, stats = [], Counter()
+        for values, id_type in registers:
+            key = (values['serial_number'], values['issue_date'])
+            issuer = _issuer_tax_identifier(values, id_type)
+            if issuer:
+                candidates = by_issuer.get(key + (issuer,), [])
             else:
-                periods1[period] = [invoice]
-        issued_invoices['A0'] = periods1
+                candidates = by_date.get(key, [])
+            if len(candidates) == 1:
+                result.append(candidates[0])
+                stats['matched'] += 1
+            else:
+                result.append(None)
+                stats['ambiguous' if candidates else 'missing'] += 1
+        return result, stats
 
+    @classmethod
+    def get_issued_sii_reports(cls):
         book_type = 'E'  # Issued
-        return cls.create_sii_book(issued_invoices, book_type)
+        return cls.create_sii_book(cls._get_pending_sii_invoices('out'),
+            book_type)
 
     @classmethod
     def get_received_sii_reports(cls):
+        book_type = 'R'  # Received
+        return cls.create_sii_book(cls._get_pending_sii_invoices('in'),
+            book_type)
+
+    @classmethod
+    def _get_pending_sii_invoices(cls, type_):
+        '''
+        Return the invoices of type_ pending to be sent by operation and
+        period.
+
+        The registered invoices are amended (A1) when their header is the one
+        of their last report line and otherwise deleted (D0) and registered
+        again (A0), all of them classified by a single query.
+        '''
         pool = Pool()
         Invoice = pool.get('account.invoice')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
         SIIReportLine = pool.get('aeat.sii.report.lines')
+        invoice = Invoice.__table__()
+        move = Move.__table__()
+        line = SIIReportLine.__table__()
+        cursor = Transaction().connection.cursor()
 
-        received_invoices = {
-            'A0': {}, # 'A0', 'Registration of invoices/records'
-            'A1': {}, # 'A1', 'Amendment of invoices/records (registration errors)'
-            'D0': {}, # 'D0', 'Delete Invoices'
+        last_line = line.select(line.invoice, line.sii_header_digest,
+            RowNumber(window=Window([line.invoice],
+                    order_by=[line.id.desc])).as_('rank'),
+            where=line.invoice != Null)
+        registered = ((invoice.sii_state == 'Correcto')
+            & (invoice.sii_header != Null) & (invoice.sii_header != ''))
+        operation = Case(
+            (registered & (last_line.invoice == Null), Null),
+            (registered & (invoice.sii_header_digest
+                    == last_line.sii_header_digest), 'A1'),
+            (registered, 'D0'),
+            ((invoice.sii_state == Null)
+                | invoice.sii_state.in_(['Incorrecto', 'Anulada']), 'A0'),
+            else_=Null)
+        query = invoice.join(move, condition=invoice.move == move.id
+            ).join(last_line, 'LEFT',
+                condition=(last_line.invoice == invoice.id)
+                & (last_line.rank == 1)
+            ).select(invoice.id, move.period, operation,
+                where=(invoice.sii_pending_sending == Literal(True))
+                & (invoice.type == type_)
+                & (invoice.company == Transaction().context.get('company')),
+                order_by=invoice.id)
+        cursor.execute(*query)
+        rows = [r for r in cursor.fetchall() if r[2]]
+
+        invoices = Invoice.browse([r[0] for r in rows])
+        periods = {p.id: p for p in Period.browse(list({r[1] for r in rows}))}
+        pending = {
+            'A0': {},  # Registration of invoices/records
+            'A1': {},  # Amendment of invoices/records (registration errors)
+            'D0': {},  # Delete Invoices
             }
-
-        received_invs = Invoice.search([
-                ('sii_pending_sending', '=', True),
-                ('sii_state', '=', 'Correcto'),
-                ('sii_header', '!=', None),
-                ('type', '=', 'in'),
-                ])
-        # search received invoices [delete]
-        delete_received_invoices = []
-        # search received invoices [modify]
-        modify_received_invoices = []
-        for received_inv in received_invs:
-            if not received_inv.sii_records:
-                continue
-            sii_record_id = max([s.id for s in received_inv.sii_records])
-            sii_record = SIIReportLine(sii_record_id)
-            if received_inv.sii_header:
-                if (literal_eval(received_inv.sii_header) ==
-                        literal_eval(sii_record.sii_header)):
-                    modify_received_invoices.append(received_inv)
-                else:
-                    delete_received_invoices.append(received_inv)
-
-        periods2 = {}
-        for invoice in modify_received_invoices:
-            period = invoice.move.period
-            if period in periods2:
-                periods2[period].append(invoice,)
-            else:
-                periods2[period] = [invoice]
-        received_invoices['A1'] = periods2
-
-        periods = {}
-        for invoice in delete_received_invoices:
-            period = invoice.move.period
-            if period in periods:
-                periods[period].append(invoice,)
-            else:
-                periods[period] = [invoice]
-        received_invoices['D0'] = periods
-
-        # search received invoices [new]
-        new_received_invoices = Invoice.search([
-                ('sii_state', 'in', (None, 'Incorrecto', 'Anulada')),
-                ('sii_pending_sending', '=', True),
-                ('type', '=', 'in'),
-                ('move', '!=', None),
-                ])
-
-        new_received_invoices += delete_received_invoices
-
-        periods1 = {}
-        for invoice in new_received_invoices:
-            period = invoice.move.period
-            if period in periods1:
-                periods1[period].append(invoice,)
-            else:
-                periods1[period] = [invoice]
-        received_invoices['A0'] = periods1
-
-        book_type = 'R'  # Received
-        return cls.create_sii_book(received_invoices, book_type)
+        for invoice, (_, period, operation) in zip(invoices, rows):
+            period = periods[period]
+            pending[operation].setdefault(period, []).append(invoice)
+            if operation == 'D0':
+                pending['A0'].setdefault(period, []).append(invoice)
+        return pending
 
     @classmethod
     def create_sii_book(cls, book_invoices, book):
         pool = Pool()
+        Invoice = pool.get('account.invoice')
         SIIReport = pool.get('aeat.sii.report')
-        SIIReportLine = pool.get('aeat.sii.report.lines')
         Company = Pool().get('company.company')
 
         company = Transaction().context.get('company')
         company = Company(company)
         company_vat = company.party.sii_vat_code
 
-        cursor = Transaction().connection.cursor()
-        report_line_table = SIIReportLine.__table__()
-
-        reports = []
+        blocks = []
+        to_create = []
         for operation in ['D0', 'A1', 'A0']:
             values = book_invoices[operation]
-            delete = True if operation == 'D0' else False
             for period, invoices in values.items():
                 for invs in grouped_slice(invoices, MAX_SII_LINES):
-                    report = SIIReport()
-                    report.company = company
-                    report.company_vat = company_vat
-                    report.fiscalyear = period.fiscalyear
-                    report.period = period
-                    report.operation_type = operation
-                    report.book = book
-                    report.save()
-                    reports.append(report)
-
-                    values = []
-                    for inv in invs:
-                        sii_header = str(inv.get_sii_header(inv, delete))
-                        values.append([report.id, inv.id, sii_header, company.id])
-
-                    cursor.execute(*report_line_table.insert(
-                            columns=[report_line_table.report,
-                                report_line_table.invoice,
-                                report_line_table.sii_header,
-                                report_line_table.company],
-                            values=values
-                            ))
+                    blocks.append((operation, list(invs)))
+                    to_create.append({
+                            'company': company.id,
+                            'company_vat': company_vat,
+                            'fiscalyear': period.fiscalyear.id,
+                            'period': period.id,
+                            'operation_type': operation,
+                            'book': book,
+                            })
+        reports = SIIReport.create(to_create)
 
+        # The headers of each operation are built in a single batch
+        headers = {}
+        for operation in ['D0', 'A1', 'A0']:
+            invoices = [i for o, invs in blocks if o == operation
+                for i in invs]
+            delete = True if operation == 'D0' else False
+            headers[operation] = iter(
+                Invoice.get_sii_headers(invoices, delete))
+
+        lines = []
+        for report, (operation, invs) in zip(reports, blocks):
+            for inv in invs:
+                sii_header = tools.dumps_header(next(headers[operation]))
+                lines.append((report.id, inv.id, sii_header,
+                        tools.header_digest(sii_header), company.id))
+        cls._insert_report_lines(lines)
         return reports
 
+    @classmethod
+    def _insert_report_lines(cls, lines):
+        '''
+        Insert the report lines given as (report, invoice, sii_header,
+        sii_header_digest, company) with COPY on PostgreSQL and with
+        multi-row INSERTs otherwise.
+
+        The create user and date are filled as ModelSQL.create does.
+        '''
+        pool = Pool()
+        SIIReportLine = pool.get('aeat.sii.report.lines')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = SIIReportLine.__table__()
+
+        columns = [table.report, table.invoice, table.sii_header,
+            table.sii_header_digest, table.company, table.create_uid,
+            table.create_date]
+        if backend.name == 'postgresql':
+            # COPY only takes values, the column casts the timestamp as the
+            # INSERT of ModelSQL.create does
+            cursor.execute(*Select([Cast(CurrentTimestamp(), 'timestamp')]))
+            now, = cursor.fetchone()
+            lines = [tuple(l) + (transaction.user, now) for l in lines]
+            data = io.StringIO(''.join(
+                    '\t'.join(map(_copy_value, line)) + '\n'
+                    for line in lines))
+            cursor.copy_from(data, SIIReportLine._table,
+                columns=[c.name for c in columns])
+        else:
+            for sub_lines in grouped_slice(lines,
+                    transaction.database.IN_MAX // len(columns)):
+                cursor.execute(*table.insert(columns=columns,
+                        values=[list(l) + [transaction.user,
+                                CurrentTimestamp()] for l in sub_lines]))
+
     @classmethod
     def find_reports(cls, book='E'):
         return cls.search([
@@ -1156,6 +1407,8 @@ class SIIReportLine(ModelSQL, ModelView):
     exemption_cause = fields.Char('Exemption Cause', readonly=True)
     aeat_register = fields.Text('Register from AEAT Webservice', readonly=True)
     sii_header = fields.Text('Header')
+    sii_header_digest = fields.Char('Header Digest', readonly=True,
+        select=True)
 
     @classmethod
     def __register__(cls, module_name):
@@ -1164,9 +1417,14 @@ class SIIReportLine(ModelSQL, ModelView):
         exist_sii_excemption_key = table.column_exist('exemption_key')
         if exist_sii_excemption_key:
             table.column_rename('exemption_key', 'exemption_cause')
+        exist_sii_header_digest = table.column_exist('sii_header_digest')
 
         super(SIIReportLine, cls).__register__(module_name)
 
+        if not exist_sii_header_digest:
+            tools.migrate_headers(Transaction().connection.cursor(),
+                cls.__table__())
+
     def get_invoice_operation_key(self, name):
         return self.invoice.sii_operation_key if self.invoice else None
 
@@ -1216,23 +1474,30 @@ class SIIReportLine(ModelSQL, ModelView):
         Invoice = pool.get('account.invoice')
         SIIReport = pool.get('aeat.sii.report')
 
-        to_write = []
         vlist = [x.copy() for x in vlist]
+        reports = SIIReport.browse(list({v['report'] for v in vlist
+                    if v.get('report')}))
+        deleted = {r.id for r in reports if r.operation_type == 'D0'}
+
+        # The headers are built in one batch per kind of request
+        for delete in [True, False]:
+            values = [v for v in vlist if v.get('invoice')
+                and (v.get('report') in deleted) == delete]
+            invoices = Invoice.browse([v['invoice'] for v in values])
+            for vals, sii_header in zip(values,
+                    Invoice.get_sii_headers(invoices, delete)):
+                vals['sii_header'] = tools.dumps_header(sii_header)
         for vals in vlist:
-            invoice = (Invoice(id=vals['invoice'])
-                if vals.get('invoice') else None)
-            report = (SIIReport(id=vals['report'])
-                if vals.get('report') else None)
-
-            delete = True if report and report.operation_type == 'D0' else False
-            vals['sii_header'] = (str(invoice.get_sii_header(invoice, delete))
-                if invoice else '')
-            if vals.get('state', None) == 'Correcto' and invoice:
-                to_write.extend(([invoice], {
-                        'sii_pending_sending': False,
-                        }))
+            if not vals.get('invoice'):
+                vals['sii_header'] = ''
+            vals['sii_header_digest'] = tools.header_digest(vals['sii_header'])
+
+        to_write = Invoice.browse(list({v['invoice'] for v in vlist
+                    if v.get('invoice') and v.get('state') == 'Correcto'}))
         if to_write:
-            Invoice.write(*to_write)
+            Invoice.write(to_write, {
+                    'sii_pending_sending': False,
+                    })
         return super(SIIReportLine, cls).create(vlist)
 
     @classmethod
@@ -1241,33 +1506,39 @@ class SIIReportLine(ModelSQL, ModelView):
         Invoice = pool.get('account.invoice')
 
         actions = iter(args)
+        args = []
 
-        to_write = []
+        # Invoices to update by their new values
+        sent, duplicated = set(), set()
         for lines, values in zip(actions, actions):
-            invoice_values = {
-                'sii_pending_sending': False,
-                }
+            values = tools.with_header_digest(values)
+            args.extend((lines, values))
             if values.get('state', None) == 'Correcto':
-                invoices = [x.invoice for x in lines]
+                sent.update(x.invoice for x in lines)
             else:
-                invoices = [x.invoice for x in lines
-                    if x.state == 'Correcto']
-            if invoices:
-                to_write.extend((invoices, invoice_values))
-
-            invoice_vals = {
-                'sii_pending_sending': False,
-                'sii_state': 'duplicated_unsubscribed',
-                }
+                sent.update(x.invoice for x in lines
+                    if x.state == 'Correcto')
+
             if values.get('communication_code', None) in (3000, 3001):
-                invoices = [x.invoice for x in lines]
+                duplicated.update(x.invoice for x in lines)
             else:
-                invoices = [x.invoice for x in lines
-                    if x.communication_code in (3000, 3001)]
-            if invoices:
-                to_write.extend((invoices, invoice_vals))
+                duplicated.update(x.invoice for x in lines
+                    if x.communication_code in (3000, 3001))
+        sent.discard(None)
+        duplicated.discard(None)
+        sent -= duplicated
 
         super(SIIReportLine, cls).write(*args)
+        to_write = []
+        if sent:
+            to_write.extend((list(sent), {
+                        'sii_pending_sending': False,
+                        }))
+        if duplicated:
+            to_write.extend((list(duplicated), {
+                        'sii_pending_sending': False,
+                        'sii_state': 'duplicated_unsubscribed',
+                        }))
         if to_write:
             Invoice.write(*to_write)
 
@@ -1276,29 +1547,56 @@ class SIIReportLine(ModelSQL, ModelView):
         pool = Pool()
         Invoice = pool.get('account.invoice')
 
-        to_save = []
-        for line in lines:
-            invoice = line.invoice
-            if invoice:
-                last_line = cls.search([
-                        ('invoice', '=', invoice),
-                        ('id', '!=', line.id),
-                        ('report.operation_type', '!=', 'C0'),
-                        ], order=[('report', 'DESC')], limit=1)
-                last_line = last_line[0] if last_line else None
-                if last_line:
-                    invoice.sii_communication_type = (
-                        last_line.report.operation_type)
-                    invoice.sii_state = last_line.state
-                    to_save.append(invoice)
-                else:
-                    invoice.sii_communication_type = None
-                    invoice.sii_state = None
-                    to_save.append(invoice)
-        if to_save:
-            Invoice.save(to_save)
+        invoices = {l.invoice for l in lines if l.invoice}
+        previous = cls._get_previous_lines(invoices, lines)
+
+        # Invoices to update by their new values
+        to_update = {}
+        for invoice in invoices:
+            values = previous.get(invoice.id, (None, None))
+            to_update.setdefault(values, []).append(invoice)
+        to_write = []
+        for (communication_type, state), invoices in to_update.items():
+            to_write.extend((invoices, {
+                        'sii_communication_type': communication_type,
+                        'sii_state': state,
+                        }))
+        if to_write:
+            Invoice.write(*to_write)
         super(SIIReportLine, cls).delete(lines)
 
+    @classmethod
+    def _get_previous_lines(cls, invoices, lines):
+        '''
+        Return the operation type and state of the line of the last created
+        report of each invoice besides lines and the lines of C0 reports, by
+        invoice id.
+        '''
+        pool = Pool()
+        SIIReport = pool.get('aeat.sii.report')
+        line = cls.__table__()
+        report = SIIReport.__table__()
+        cursor = Transaction().connection.cursor()
+
+        excluded = [l.id for l in lines]
+        result = {}
+        for sub_invoices in grouped_slice([i.id for i in invoices]):
+            ranked = line.join(report, condition=line.report == report.id
+                ).select(line.invoice, report.operation_type, line.state,
+                    RowNumber(window=Window([line.invoice],
+                            order_by=[report.create_date.desc,
+                                report.id.desc, line.id.desc])
+                        ).as_('rank'),
+                    where=reduce_ids(line.invoice, sub_invoices)
+                    & ~reduce_ids(line.id, excluded)
+                    & (report.operation_type != 'C0'))
+            cursor.execute(*ranked.select(ranked.invoice,
+                    ranked.operation_type, ranked.state,
+                    where=ranked.rank == 1))
+            for invoice, operation_type, state in cursor:
+                result[invoice] = (operation_type, state)
+        return result
+
 
 class SIIReportLineTax(ModelSQL, ModelView):
     '''
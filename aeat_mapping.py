@@ -1,14 +1,25 @@
 # -*- coding: utf-8 -*-
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import copy
+import os
+import pickle
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
-from logging import getLogger
+from itertools import chain
+from logging import getLogger, DEBUG
 from operator import attrgetter
 from datetime import date
+from threading import Lock
 
+from trytond.cache import LRUDict
+from trytond.config import config
 from trytond.i18n import gettext
 from trytond.model import Model
 from trytond.pool import Pool
+from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from . import tools
 
@@ -24,8 +35,213 @@ OTHER_ID_TYPES = frozenset({'02', '03', '04', '05', '06', '07'})
 SEMESTER1_ISSUED_SPECIALKEY = '16'
 SEMESTER1_RECIEVED_SPECIALKEY = '14'
 
+# Number of processes mapping the submit requests of large batches, they are
+# new interpreters that read the invoices in their own transaction
+MAPPING_PROCESSES = config.getint('aeat', 'sii_mapping_processes', default=0)
+# Smaller batches are always mapped in the worker process
+MAPPING_THRESHOLD = config.getint('aeat', 'sii_mapping_threshold',
+    default=5000)
+_MAPPING_WORKER = ('from trytond.modules.aeat_sii.aeat_mapping import '
+    '_mapping_worker; _mapping_worker()')
+
+# Requests already built are kept by invoice revision so the headers and
+# submissions of the same invoice are built once across reports and retries
+PAYLOAD_CACHE_SIZE = config.getint('aeat', 'sii_payload_cache',
+    default=5000)
+_payloads = LRUDict(PAYLOAD_CACHE_SIZE)
+_payloads_lock = Lock()
+_payloads_stats = {'hits': 0, 'misses': 0}
+
+
+def raise_errors(errors):
+    "Raise the messages of the errors of a batch as a single UserError"
+    if errors:
+        raise UserError(gettext('aeat_sii.msg_service_message',
+                message='\n'.join(e.message for _, e in errors)))
+
+
+def _mapping_environ():
+    "Return the environment of the mapping processes with the configuration"
+    environ = {k: v for k, v in os.environ.items()
+        if not k.startswith('TRYTOND_')}
+    # trytond.config reads them before any module is imported
+    for section in config.sections():
+        for option, value in config.items(section, raw=True):
+            environ['TRYTOND_%s__%s' % (section.upper(), option.upper())] = (
+                value)
+    return environ
+
+
+def _run_mapping_process(job, environ):
+    process = subprocess.Popen([sys.executable, '-c', _MAPPING_WORKER],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environ)
+    output, _ = process.communicate(pickle.dumps(job))
+    if process.returncode:
+        raise RuntimeError('Mapping process exited with status %s'
+            % process.returncode)
+    return pickle.loads(output)
+
+
+def _mapping_worker():
+    "Map the invoices of the job read from stdin and write their requests"
+    output = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    job = pickle.load(sys.stdin.buffer)
+    Pool(job['database']).init()
+    with Transaction().start(job['database'], job['user'], readonly=True,
+            context=job['context']):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        mapper = pool.get(job['mapper'])()
+        # The errors are raised by the parent process to translate them
+        requests, _ = mapper._build_requests(Invoice.browse(job['invoices']),
+            'submit', mapper.submit_prefetch, processes=0)
+    pickle.dump(requests, output)
+    output.flush()
+
+
+def payload_cache_stats():
+    "Return the hit counters of the requests cache"
+    with _payloads_lock:
+        stats = dict(_payloads_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / total if total else 0
+    return stats
+
+
+def clear_payload_cache():
+    with _payloads_lock:
+        _payloads.clear()
+
+
+class TaxBreakdown(object):
+    '''
+    Taxes of an invoice as read by the mappers, computed in a single pass
+    over its taxes and lines.
+    '''
+
+    def __init__(self, mapper, invoice):
+        self.invoice = invoice.id
+        # Taxes reported in the breakdown and in the total amount
+        self.taxes = []
+        self.total_taxes = []
+        # Equivalence surcharge of each invoice tax by its id
+        self.surcharges = {}
+
+        surcharges = {}
+        for invoice_tax in invoice.taxes:
+            tax = invoice_tax.tax
+            if tax.recargo_equivalencia:
+                surcharges.setdefault(tax.id, []).append(invoice_tax)
+                continue
+            if tax.tax_used:
+                self.taxes.append(invoice_tax)
+            if tax.invoice_used:
+                self.total_taxes.append(invoice_tax)
+        if surcharges:
+            for invoice_tax in invoice.taxes:
+                related = invoice_tax.tax.recargo_equivalencia_related_tax
+                for surcharge in surcharges.get(
+                        related.id if related else None, []):
+                    if surcharge.base == surcharge.base.copy_sign(
+                            invoice_tax.base):
+                        self.surcharges[invoice_tax.id] = surcharge
+                        break
+
+        self.base = 0
+        self.amount = 0
+        self.surcharge_amount = 0
+        bases = {}
+        for invoice_tax in self.total_taxes:
+            base = mapper.get_tax_base(invoice_tax)
+            self.amount += mapper.get_tax_amount(invoice_tax)
+            surcharge = self.surcharges.get(invoice_tax.id)
+            if surcharge:
+                self.surcharge_amount += mapper.tax_amount(surcharge) or 0
+            # Taxes of the same parent with the same base share it
+            parent = invoice_tax.tax.parent or invoice_tax.tax
+            if parent.id in bases and bases[parent.id] == base:
+                continue
+            self.base += base
+            bases[parent.id] = base
+
+        self.not_subject = 0
+        self.location_rules = 0
+        for line in invoice.lines:
+            for tax in line.taxes:
+                if tax.sii_exemption_cause == 'NotSubject':
+                    self.not_subject += line.amount
+                if tax.sii_issued_key == '08':
+                    self.location_rules += line.amount
+
+    @property
+    def total(self):
+        return self.amount + self.base + self.surcharge_amount
+
 
 class BaseInvoiceMapper(Model):
+    # Related records read to build the requests, see prefetch()
+    delete_prefetch = ('move.period', 'company.party')
+    submit_prefetch = delete_prefetch + (
+        'company.party.tax_identifier',
+        'party.tax_identifier',
+        'party.identifiers',
+        'invoice_address.country',
+        'taxes.tax.parent',
+        'taxes.tax.recargo_equivalencia_related_tax',
+        'taxes.company_amount',
+        'taxes.company_base',
+        'lines.taxes',
+        'lines.amount',
+        )
+    # Fields read by the mapping of submit requests, the cached requests are
+    # rebuilt when a record reached by them changes so overrides reading other
+    # fields must extend it
+    mapped_fields = (
+        'number',
+        'reference',
+        'invoice_date',
+        'type',
+        'description',
+        'sii_operation_key',
+        'sii_issued_key',
+        'sii_received_key',
+        'move.date',
+        'move.period.start_date',
+        'company.party.name',
+        'company.party.sii_vat_code',
+        'company.party.sii_identifier_type',
+        'company.party.tax_identifier.code',
+        'party.name',
+        'party.rec_name',
+        'party.sii_identifier_type',
+        'party.tax_identifier.code',
+        'party.identifiers.code',
+        'invoice_address.country.code',
+        'taxes.invoice',
+        'taxes.base',
+        'taxes.tax.name',
+        'taxes.tax.rate',
+        'taxes.tax.tax_used',
+        'taxes.tax.invoice_used',
+        'taxes.tax.recargo_equivalencia',
+        'taxes.tax.deducible',
+        'taxes.tax.sii_subjected_key',
+        'taxes.tax.sii_exemption_cause',
+        'lines.description',
+        'lines.taxes.sii_exemption_cause',
+        'lines.taxes.sii_issued_key',
+        )
+
+    __slots__ = ('_tax_breakdown', '_batch_cache')
+
+    def __init__(self, *args, **kwargs):
+        super(BaseInvoiceMapper, self).__init__(*args, **kwargs)
+        # Breakdown of the invoice being mapped, see tax_breakdown()
+        self._tax_breakdown = None
+        # Values shared by the invoices of a batch, see _build_requests()
+        self._batch_cache = None
+
     year = attrgetter('move.period.start_date.year')
     period = attrgetter('move.period.start_date.month')
     nif = attrgetter('company.party.sii_vat_code')
@@ -39,13 +255,18 @@ class BaseInvoiceMapper(Model):
     def exempt_kind(self, tax):
         return attrgetter('sii_exemption_cause')(tax)
 
+    def tax_breakdown(self, invoice):
+        '''
+        Return the TaxBreakdown of invoice, it is kept until the next
+        submit request is built.
+        '''
+        breakdown = self._tax_breakdown
+        if breakdown is None or breakdown.invoice != invoice.id:
+            breakdown = self._tax_breakdown = TaxBreakdown(self, invoice)
+        return breakdown
+
     def not_subject(self, invoice):
-        base = 0
-        for line in invoice.lines:
-            for tax in line.taxes:
-                if tax.sii_exemption_cause == 'NotSubject':
-                    base += attrgetter('amount')(line)
-        return base
+        return self.tax_breakdown(invoice).not_subject
 
     def counterpart_nif(self, invoice):
         nif = ''
@@ -70,22 +291,7 @@ class BaseInvoiceMapper(Model):
         return val
 
     def get_invoice_total(self, invoice):
-        taxes = self.total_invoice_taxes(invoice)
-        taxes_base = 0
-        taxes_amount = 0
-        taxes_surcharge = 0
-        taxes_used = {}
-        for tax in taxes:
-            base = self.get_tax_base(tax)
-            taxes_amount += self.get_tax_amount(tax)
-            taxes_surcharge += self.tax_equivalence_surcharge_amount(tax) or 0
-            parent = tax.tax.parent if tax.tax.parent else tax.tax
-            if (parent.id in list(taxes_used.keys()) and
-                    base == taxes_used[parent.id]):
-                continue
-            taxes_base += base
-            taxes_used[parent.id] = base
-        return (taxes_amount + taxes_base + taxes_surcharge)
+        return self.tax_breakdown(invoice).total
 
     def counterpart_id_type(self, invoice):
         if invoice.sii_operation_key == 'F5':
@@ -132,25 +338,14 @@ class BaseInvoiceMapper(Model):
             ])
 
     def taxes(self, invoice):
-        return [invoice_tax for invoice_tax in invoice.taxes if (
-                invoice_tax.tax.tax_used and
-                not invoice_tax.tax.recargo_equivalencia)]
+        return self.tax_breakdown(invoice).taxes
 
     def total_invoice_taxes(self, invoice):
-        return [invoice_tax for invoice_tax in invoice.taxes if (
-                invoice_tax.tax.invoice_used and
-                not invoice_tax.tax.recargo_equivalencia)]
+        return self.tax_breakdown(invoice).total_taxes
 
     def _tax_equivalence_surcharge(self, invoice_tax):
-        surcharge_tax = None
-        for invoicetax in invoice_tax.invoice.taxes:
-            if (invoicetax.tax.recargo_equivalencia and
-                    invoice_tax.tax.recargo_equivalencia_related_tax ==
-                    invoicetax.tax and invoicetax.base ==
-                    invoicetax.base.copy_sign(invoice_tax.base)):
-                surcharge_tax = invoicetax
-                break
-        return surcharge_tax
+        return self.tax_breakdown(invoice_tax.invoice).surcharges.get(
+            invoice_tax.id)
 
     def tax_equivalence_surcharge_rate(self, invoice_tax):
         surcharge_tax = self._tax_equivalence_surcharge(invoice_tax)
@@ -162,7 +357,21 @@ class BaseInvoiceMapper(Model):
         if surcharge_tax:
             return self.tax_amount(surcharge_tax)
 
+    def _batch_value(self, key, func, invoice):
+        if self._batch_cache is None:
+            return func(invoice)
+        try:
+            return self._batch_cache[key]
+        except KeyError:
+            value = self._batch_cache[key] = func(invoice)
+            return value
+
     def _build_period(self, invoice):
+        period = self._batch_value(('period', invoice.move.period.id),
+            self._compute_period, invoice)
+        return dict(period)
+
+    def _compute_period(self, invoice):
         return {
             'Ejercicio': self.year(invoice),
             'Periodo': tools._format_period(self.period(invoice)),
@@ -207,6 +416,135 @@ class BaseInvoiceMapper(Model):
             else _FIRST_SEMESTER_RECORD_DESCRIPTION
         )
 
+    def prefetch(self, invoices, paths):
+        '''
+        Return the invoices browsed together with their related records on
+        paths read in batches.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        invoices = Invoice.browse([i.id for i in invoices])
+        tools.prefetch(invoices, paths)
+        return invoices
+
+    def build_submit_requests(self, invoices):
+        '''
+        Return the submit requests of invoices in the same order, None for
+        the invoices that could not be mapped, and the list of (invoice,
+        error) of those.
+        '''
+        return self._build_requests(invoices, 'submit', self.submit_prefetch,
+            processes=MAPPING_PROCESSES)
+
+    def build_delete_requests(self, invoices):
+        '''
+        Return the delete requests of invoices like build_submit_requests.
+        '''
+        return self._build_requests(invoices, 'delete', self.delete_prefetch)
+
+    def revision(self, invoice):
+        '''
+        Return the revision of the records the requests of invoice are built
+        from, the cached requests are reused while it does not change.
+
+        It is made of the write date of the invoice and of its lines, the
+        fields of the invoice read by the mapping and the write date of every
+        related record reached by the prefetch paths and mapped_fields.
+        Mappers reading other records must add their paths to mapped_fields.
+        '''
+        paths = (self.delete_prefetch + self.submit_prefetch
+            + self.mapped_fields)
+        values = tuple(getattr(invoice, name, None)
+            for name in ('sii_book_key',) + paths if '.' not in name)
+        related = {invoice}
+        related.update(invoice.lines)
+        related.update(tools.related_records(invoice, paths))
+        related = sorted((r.__name__, r.id, r.write_date or r.create_date)
+            for r in related)
+        return values + tuple(related)
+
+    def _build_requests(self, invoices, kind, paths, processes=0):
+        build = getattr(self, 'build_%s_request' % kind)
+        debug = _logger.isEnabledFor(DEBUG)
+        with tools.QueryCounter(debug) as prefetch:
+            invoices = self.prefetch(invoices, paths)
+        if PAYLOAD_CACHE_SIZE:
+            database = Transaction().database.name
+            keys = [(database, self.__name__, kind, i.id, self.revision(i))
+                for i in invoices]
+            with _payloads_lock:
+                requests = [_payloads.get(k) for k in keys]
+        else:
+            keys = [None] * len(invoices)
+            requests = [None] * len(invoices)
+        missing = [i for i, r in enumerate(requests) if r is None]
+
+        errors = []
+        self._batch_cache = {}
+        try:
+            with tools.QueryCounter(debug) as mapping:
+                if processes > 1 and len(missing) >= MAPPING_THRESHOLD:
+                    mapped = self._map_in_processes(
+                        [invoices[i] for i in missing], processes)
+                else:
+                    mapped = [None] * len(missing)
+                for i, request in zip(missing, mapped):
+                    if request is None:
+                        try:
+                            request = build(invoices[i])
+                        except UserError as e:
+                            errors.append((invoices[i], e))
+                            continue
+                    requests[i] = request
+        finally:
+            self._batch_cache = None
+            self._tax_breakdown = None
+
+        with _payloads_lock:
+            if PAYLOAD_CACHE_SIZE:
+                for i in missing:
+                    if requests[i] is not None:
+                        _payloads[keys[i]] = requests[i]
+            _payloads_stats['hits'] += len(invoices) - len(missing)
+            _payloads_stats['misses'] += len(missing)
+        # The cached requests are shared
+        requests = [copy.deepcopy(r) for r in requests]
+        _logger.debug('%s invoices mapped with %s errors, %s cached, '
+            'queries: %s prefetching, %s mapping', len(invoices), len(errors),
+            len(invoices) - len(missing), prefetch.count, mapping.count)
+        return requests, errors
+
+    def _map_in_processes(self, invoices, processes):
+        '''
+        Return the submit requests of invoices mapped by processes, None for
+        the invoices that must be mapped by this one.
+
+        The processes read the committed invoices, so they must not have been
+        changed by the current transaction.
+        '''
+        transaction = Transaction()
+        size = -(-len(invoices) // processes)
+        jobs = [{
+                'database': transaction.database.name,
+                'user': transaction.user,
+                'context': transaction.context,
+                'mapper': self.__name__,
+                'invoices': [i.id for i in invoices[n:n + size]],
+                } for n in range(0, len(invoices), size)]
+        environ = _mapping_environ()
+        try:
+            with ThreadPoolExecutor(len(jobs)) as executor:
+                requests = list(chain.from_iterable(executor.map(
+                            lambda job: _run_mapping_process(job, environ),
+                            jobs)))
+        except Exception:
+            _logger.warning('Mapping %s invoices in processes failed',
+                len(invoices), exc_info=True)
+            return [None] * len(invoices)
+        _logger.debug('%s invoices mapped by %s processes, %s left',
+            len(invoices), len(jobs), requests.count(None))
+        return requests
+
     def build_query_filter(self, year=None, period=None, last_invoice=None):
         # TODO: IDFactura, Contraparte,
         # FechaPresentacion, FechaCuadre, FacturaModificada,
@@ -241,13 +579,15 @@ class IssuedInvoiceMapper(BaseInvoiceMapper):
         }
 
     def build_submit_request(self, invoice):
+        self._tax_breakdown = None
         request = self.build_delete_request(invoice)
         request['FacturaExpedida'] = self.build_issued_invoice(invoice)
         return request
 
     def _build_issuer_id(self, invoice):
         return {
-            'NIF': self.nif(invoice),
+            'NIF': self._batch_value(('nif', invoice.company.id), self.nif,
+                invoice),
         }
 
     def build_taxes(self, tax):
@@ -257,23 +597,18 @@ class IssuedInvoiceMapper(BaseInvoiceMapper):
             'CuotaRepercutida': self.tax_amount(tax)
             }
 
-        if self.tax_equivalence_surcharge_rate(tax):
+        surcharge_rate = self.tax_equivalence_surcharge_rate(tax)
+        if surcharge_rate:
             res['TipoRecargoEquivalencia'] = (
-                tools._rate_to_percent(self.tax_equivalence_surcharge_rate(
-                        tax)))
+                tools._rate_to_percent(surcharge_rate))
 
-        if self.tax_equivalence_surcharge_amount(tax):
-            res['CuotaRecargoEquivalencia'] = (
-                self.tax_equivalence_surcharge_amount(tax))
+        surcharge_amount = self.tax_equivalence_surcharge_amount(tax)
+        if surcharge_amount:
+            res['CuotaRecargoEquivalencia'] = surcharge_amount
         return res
 
     def location_rules(self, invoice):
-        base = 0
-        for line in invoice.lines:
-            for tax in line.taxes:
-                if tax.sii_issued_key == '08':
-                    base += attrgetter('amount')(line)
-        return base
+        return self.tax_breakdown(invoice).location_rules
 
     def build_issued_invoice(self, invoice):
         ret = {
@@ -374,15 +709,15 @@ class IssuedInvoiceMapper(BaseInvoiceMapper):
                             }
                         }
                     })
-        if self.not_subject(invoice):
+        not_subject = self.not_subject(invoice)
+        if not_subject:
             detail['NoSujeta'].update({
-                    'ImportePorArticulos7_14_Otros': self.not_subject(
-                        invoice),
+                    'ImportePorArticulos7_14_Otros': not_subject,
                     })
-        if self.location_rules(invoice):
+        location_rules = self.location_rules(invoice)
+        if location_rules:
             detail['NoSujeta'].update({
-                    'ImporteTAIReglasLocalizacion': self.location_rules(
-                        invoice)
+                    'ImporteTAIReglasLocalizacion': location_rules,
                     })
 
         # remove unused key
@@ -430,6 +765,13 @@ class RecievedInvoiceMapper(BaseInvoiceMapper):
     Tryton Recieved Invoice to AEAT mapper
     """
     __name__ = 'aeat.sii.recieved.invoice.mapper'
+    # The issuer of received invoices is the counterpart
+    delete_prefetch = BaseInvoiceMapper.delete_prefetch + (
+        'party.tax_identifier',
+        'party.identifiers',
+        'invoice_address.country',
+        'taxes.tax',
+        )
     serial_number = attrgetter('reference')
     specialkey_or_trascendence = attrgetter('sii_received_key')
     move_date = attrgetter('move.date')
@@ -453,6 +795,13 @@ class RecievedInvoiceMapper(BaseInvoiceMapper):
             else self.sent_date(invoice)
         )
 
+    def revision(self, invoice):
+        revision = super(RecievedInvoiceMapper, self).revision(invoice)
+        # The first semester invoices are registered on the sent date
+        if self._is_first_semester(invoice):
+            revision += (self.sent_date(invoice),)
+        return revision
+
     def sent_date(self, invoice):
         # Unless overriden, the date an invoice is sent to the SII system
         # is assumed to be the date it is being mapped
@@ -465,6 +814,7 @@ class RecievedInvoiceMapper(BaseInvoiceMapper):
         }
 
     def build_submit_request(self, invoice):
+        self._tax_breakdown = None
         request = self.build_delete_request(invoice)
         request['FacturaRecibida'] = self.build_received_invoice(invoice)
         return request
@@ -519,13 +869,13 @@ class RecievedInvoiceMapper(BaseInvoiceMapper):
         if self.specialkey_or_trascendence(invoice) != '02':
             ret['TipoImpositivo'] = tools._rate_to_percent(self.tax_rate(tax))
             ret['CuotaSoportada'] = self.tax_amount(tax)
-            if self.tax_equivalence_surcharge_rate(tax):
+            surcharge_rate = self.tax_equivalence_surcharge_rate(tax)
+            if surcharge_rate:
                 ret['TipoRecargoEquivalencia'] = \
-                    tools._rate_to_percent(self.tax_equivalence_surcharge_rate(
-                            tax))
-            if self.tax_equivalence_surcharge_amount(tax):
-                ret['CuotaRecargoEquivalencia'] = \
-                    self.tax_equivalence_surcharge_amount(tax)
+                    tools._rate_to_percent(surcharge_rate)
+            surcharge_amount = self.tax_equivalence_surcharge_amount(tax)
+            if surcharge_amount:
+                ret['CuotaRecargoEquivalencia'] = surcharge_amount
             bieninversion = all(map(lambda w: w in tax.tax.name, (
                         'bien', 'inversión')))
             ret['BienInversion'] = 'S' if bieninversion else 'N'
@@ -1,21 +1,39 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import time
 from logging import getLogger
 from contextlib import contextmanager
+from functools import lru_cache
 from tempfile import NamedTemporaryFile
+from threading import Lock
 
 from cryptography.fernet import Fernet
 
+from trytond.cache import LRUDict
 from trytond.config import config
 from trytond.model import fields
 from trytond.pool import PoolMeta
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from . import service
 
 __all__ = ['Company']
 _logger = getLogger(__name__)
 
+# Decrypted private keys are kept for a short time so reading them for
+# several companies or several times in a row only decrypts them once
+PRIVATE_KEY_TTL = config.getint('aeat', 'sii_private_key_ttl', default=60)
+PRIVATE_KEY_CACHE_SIZE = config.getint('aeat', 'sii_private_key_cache',
+    default=16)
+_private_keys = LRUDict(PRIVATE_KEY_CACHE_SIZE)
+_private_keys_lock = Lock()
+
+
+@lru_cache(maxsize=None)
+def _get_fernet(fernet_key):
+    return Fernet(fernet_key)
+
 
 class Company(metaclass=PoolMeta):
     __name__ = 'company.company'
@@ -25,6 +43,23 @@ class Company(metaclass=PoolMeta):
     private_key = fields.Function(fields.Binary('Private Key'),
         'get_private_key', 'set_private_key')
 
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        certificates = []
+        to_invalidate = []
+        for companies, values in zip(actions, actions):
+            if ('pem_certificate' in values
+                    or 'encrypted_private_key' in values):
+                certificates.extend(c.pem_certificate for c in companies
+                    if c.pem_certificate)
+                to_invalidate.extend(companies)
+        super(Company, cls).write(*args)
+        for certificate in certificates:
+            service.invalidate_clients(certificate)
+        for company in to_invalidate:
+            service.invalidate_ssl_context(company._sii_ssl_context_key)
+
     @classmethod
     def get_private_key(cls, companies, name=None):
         converter = bytes
@@ -35,29 +70,47 @@ class Company(metaclass=PoolMeta):
             converter = len
             default = 0
 
-        pkeys = []
-        for company in companies:
-            key = company._get_private_key(name)
-            if not key:
-                continue
-            pkeys.append(key)
-
-        if not pkeys:
-            return {company.id:None for x in companies}
-
+        pkeys = cls._get_private_keys(companies)
         return {
-            company.id: converter(pkey) if pkey else default
-            for (company, pkey) in zip(companies, pkeys)
+            company.id: converter(pkeys[company.id])
+            if pkeys[company.id] else default
+            for company in companies
         }
 
+    @classmethod
+    def _get_private_keys(cls, companies):
+        "Return the decrypted private key of each company id"
+        database = Transaction().database.name
+        now = time.monotonic()
+        pkeys = {}
+        fernet = None
+        for values in cls.read([c.id for c in companies],
+                ['encrypted_private_key']):
+            encrypted_key = values['encrypted_private_key']
+            if not encrypted_key:
+                pkeys[values['id']] = None
+                continue
+            encrypted_key = bytes(encrypted_key)
+            key = (database, values['id'])
+            with _private_keys_lock:
+                cached = _private_keys.get(key)
+            if (cached and cached[0] == encrypted_key
+                    and now - cached[2] <= PRIVATE_KEY_TTL):
+                pkeys[values['id']] = cached[1]
+                continue
+            if fernet is None:
+                fernet = cls.get_fernet_key()
+                if not fernet:
+                    pkeys[values['id']] = None
+                    continue
+            pkey = fernet.decrypt(encrypted_key)
+            with _private_keys_lock:
+                _private_keys[key] = (encrypted_key, pkey, now)
+            pkeys[values['id']] = pkey
+        return pkeys
+
     def _get_private_key(self, name=None):
-        if not self.encrypted_private_key:
-            return None
-        fernet = self.get_fernet_key()
-        if not fernet:
-            return None
-        decrypted_key = fernet.decrypt(bytes(self.encrypted_private_key))
-        return decrypted_key
+        return self._get_private_keys([self])[self.id]
 
     @classmethod
     def set_private_key(cls, companies, name, value):
@@ -74,7 +127,23 @@ class Company(metaclass=PoolMeta):
             _logger.error('Missing Fernet key configuration')
             # raise UserError(gettext('aeat_sii.msg_missing_fernet_key'))
         else:
-            return Fernet(fernet_key)
+            return _get_fernet(fernet_key)
+
+    @property
+    def _sii_ssl_context_key(self):
+        return (Transaction().database.name, self.id)
+
+    def get_sii_ssl_context(self):
+        "Return the certificate fingerprint and the SSL context of the company"
+        # The write date changes with the certificate and the key so the
+        # context cached by another process is reloaded without reading them
+        return service.get_ssl_context(self._sii_ssl_context_key,
+            self._get_sii_credentials, self.write_date or self.create_date)
+
+    def _get_sii_credentials(self):
+        if not self.pem_certificate or not self.private_key:
+            raise UserError(gettext('aeat_sii.msg_missing_pem_cert'))
+        return bytes(self.pem_certificate), self.private_key
 
     @contextmanager
     def tmp_ssl_credentials(self):
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from lxml import etree
+
+from .tools import NAMESPACES, SOAP_NAMESPACE
+
+__all__ = ['build_envelope']
+
+# Children of the SuministroLR and AnulacionLR elements in the sequence order
+# of the ssii_1_1_bis schemas. Elements sharing their name between issued and
+# received invoices list the union of both sequences.
+_SEQUENCES = {
+    'Cabecera': ('IDVersionSii', 'Titular', 'TipoComunicacion'),
+    'Titular': ('NombreRazon', 'NIFRepresentante', 'NIF'),
+    'RegistroLRFacturasEmitidas': (
+        'PeriodoLiquidacion', 'IDFactura', 'FacturaExpedida'),
+    'RegistroLRFacturasRecibidas': (
+        'PeriodoLiquidacion', 'IDFactura', 'FacturaRecibida'),
+    'RegistroLRBajaExpedidas': ('PeriodoLiquidacion', 'IDFactura'),
+    'RegistroLRBajaRecibidas': ('PeriodoLiquidacion', 'IDFactura'),
+    'PeriodoLiquidacion': ('Ejercicio', 'Periodo'),
+    'IDFactura': ('IDEmisorFactura', 'NumSerieFacturaEmisor',
+        'NumSerieFacturaEmisorResumenFin', 'FechaExpedicionFacturaEmisor'),
+    'IDEmisorFactura': ('NombreRazon', 'NIFRepresentante', 'NIF', 'IDOtro'),
+    'Contraparte': ('NombreRazon', 'NIFRepresentante', 'NIF', 'IDOtro'),
+    'IDOtro': ('CodigoPais', 'IDType', 'ID'),
+    'FacturaExpedida': ('TipoFactura', 'TipoRectificativa',
+        'FacturasAgrupadas', 'FacturasRectificadas', 'ImporteRectificacion',
+        'FechaOperacion', 'ClaveRegimenEspecialOTrascendencia',
+        'ClaveRegimenEspecialOTrascendenciaAdicional1',
+        'ClaveRegimenEspecialOTrascendenciaAdicional2',
+        'NumRegistroAcuerdoFacturacion', 'ImporteTotal',
+        'BaseImponibleACoste', 'DescripcionOperacion', 'RefExterna',
+        'FacturaSimplificadaArticulos7.2_7.3', 'EntidadSucedida',
+        'RegPrevioGGEEoREDEMEoCompetencia', 'Macrodato', 'DatosInmueble',
+        'ImporteTransmisionInmueblesSujetoAIVA',
+        'EmitidaPorTercerosODestinatario',
+        'FacturacionDispAdicionalTerceraYsextayDelMercadoOrganizadoDelGas',
+        'VariosDestinatarios', 'Cupon',
+        'FacturaSinIdentifDestinatarioArticulo6.1.d', 'Contraparte',
+        'TipoDesglose'),
+    'FacturaRecibida': ('TipoFactura', 'TipoRectificativa',
+        'FacturasAgrupadas', 'FacturasRectificadas', 'ImporteRectificacion',
+        'FechaOperacion', 'ClaveRegimenEspecialOTrascendencia',
+        'ClaveRegimenEspecialOTrascendenciaAdicional1',
+        'ClaveRegimenEspecialOTrascendenciaAdicional2',
+        'NumRegistroAcuerdoFacturacion', 'ImporteTotal',
+        'BaseImponibleACoste', 'DescripcionOperacion', 'RefExterna',
+        'FacturaSimplificadaArticulos7.2_7.3', 'EntidadSucedida',
+        'RegPrevioGGEEoREDEMEoCompetencia', 'Macrodato', 'DesgloseFactura',
+        'Contraparte', 'FechaRegContable', 'CuotaDeducible',
+        'ADeducirEnPeriodoPosterior', 'EjercicioDeduccion',
+        'PeriodoDeduccion'),
+    'ImporteRectificacion': ('BaseRectificada', 'CuotaRectificada',
+        'CuotaRecargoRectificado'),
+    'TipoDesglose': ('DesgloseFactura', 'DesgloseTipoOperacion'),
+    'DesgloseTipoOperacion': ('PrestacionServicios', 'Entrega'),
+    'DesgloseFactura': ('Sujeta', 'NoSujeta', 'InversionSujetoPasivo',
+        'DesgloseIVA'),
+    'PrestacionServicios': ('Sujeta', 'NoSujeta'),
+    'Entrega': ('Sujeta', 'NoSujeta'),
+    'Sujeta': ('Exenta', 'NoExenta'),
+    'Exenta': ('DetalleExenta',),
+    'DetalleExenta': ('CausaExencion', 'BaseImponible'),
+    'NoExenta': ('TipoNoExenta', 'DesgloseIVA'),
+    'NoSujeta': ('ImportePorArticulos7_14_Otros',
+        'ImporteTAIReglasLocalizacion'),
+    'InversionSujetoPasivo': ('DetalleIVA',),
+    'DesgloseIVA': ('DetalleIVA',),
+    'DetalleIVA': ('TipoImpositivo', 'BaseImponible', 'CuotaRepercutida',
+        'CuotaSoportada', 'TipoRecargoEquivalencia',
+        'CuotaRecargoEquivalencia', 'PorcentCompensacionREAGYP',
+        'ImporteCompensacionREAGYP', 'BienInversion'),
+    }
+
+# Elements declared in SuministroLR.xsd, the rest come from
+# SuministroInformacion.xsd
+_LR_ELEMENTS = {'IDFactura', 'FacturaExpedida', 'FacturaRecibida'}
+
+_OPERATIONS = {
+    'SuministroLRFacturasEmitidas': 'RegistroLRFacturasEmitidas',
+    'SuministroLRFacturasRecibidas': 'RegistroLRFacturasRecibidas',
+    'AnulacionLRFacturasEmitidas': 'RegistroLRBajaExpedidas',
+    'AnulacionLRFacturasRecibidas': 'RegistroLRBajaRecibidas',
+    }
+
+_ENVELOPE = ('<soapenv:Envelope xmlns:soapenv="%s" xmlns:siiLR="%s" '
+    'xmlns:sii="%s"><soapenv:Body>' % (SOAP_NAMESPACE, NAMESPACES['siiLR'],
+        NAMESPACES['sii']))
+_ENVELOPE_END = '</soapenv:Body></soapenv:Envelope>'
+
+
+def _template(name):
+    prefix = 'siiLR' if name in _LR_ELEMENTS else 'sii'
+    return '<%s:%s>' % (prefix, name), '</%s:%s>' % (prefix, name)
+
+
+# Precompiled templates: for each element, the opening and closing tags of its
+# children by name and their position in the sequence.
+_TEMPLATES = {
+    parent: {name: _template(name) + (i,)
+        for i, name in enumerate(children)}
+    for parent, children in _SEQUENCES.items()}
+_TEMPLATES.update({
+        operation: {
+            'Cabecera': _template('Cabecera') + (0,),
+            register: ('<siiLR:%s>' % register, '</siiLR:%s>' % register, 1),
+            }
+        for operation, register in _OPERATIONS.items()})
+
+
+def _escape(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    else:
+        value = str(value)
+    if '&' in value or '<' in value or '>' in value:
+        value = (value.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;'))
+    return value
+
+
+def _write(parts, name, values):
+    template = _TEMPLATES.get(name)
+    if template is None:
+        raise TypeError('%s does not have child elements' % name)
+    try:
+        children = sorted(values.items(), key=lambda i: template[i[0]][2])
+    except KeyError as e:
+        raise TypeError('%s got an unexpected element %r' % (
+                name, e.args[0]))
+    for key, value in children:
+        if value is None:
+            continue
+        start, end, _ = template[key]
+        for value in (value if isinstance(value, (list, tuple))
+                else (value,)):
+            if value is None:
+                continue
+            parts.append(start)
+            if isinstance(value, dict):
+                _write(parts, key, value)
+            else:
+                parts.append(_escape(value))
+            parts.append(end)
+
+
+def build_envelope(operation, header, registers):
+    '''
+    Return the SOAP envelope of a SuministroLR or AnulacionLR operation.
+
+    header and registers are the structures given to the zeep service, the
+    envelope is written from the templates and parsed once by lxml without
+    validating them against the schema.
+    '''
+    parts = [_ENVELOPE, '<siiLR:%s>' % operation]
+    _write(parts, operation, {
+            'Cabecera': header,
+            _OPERATIONS[operation]: registers,
+            })
+    parts.append('</siiLR:%s>' % operation)
+    parts.append(_ENVELOPE_END)
+    return etree.fromstring(''.join(parts).encode('utf-8'))
@@ -12,6 +12,8 @@ from trytond.wizard import Wizard, StateView, StateTransition, Button
 from .aeat import (
     OPERATION_KEY, BOOK_KEY, SEND_SPECIAL_REGIME_KEY, COMMUNICATION_TYPE,
     RECEIVE_SPECIAL_REGIME_KEY, AEAT_INVOICE_STATE)
+from .aeat_mapping import raise_errors
+from . import tools
 
 
 __all__ = ['Invoice', 'ResetSIIKeysStart', 'ResetSIIKeys', 'ResetSIIKeysEnd']
@@ -44,13 +46,15 @@ class Invoice(metaclass=PoolMeta):
     sii_pending_sending = fields.Boolean('SII Pending Sending Pending',
             readonly=True)
     sii_header = fields.Text('Header')
+    sii_header_digest = fields.Char('Header Digest', readonly=True,
+        select=True)
 
     @classmethod
     def __setup__(cls):
         super(Invoice, cls).__setup__()
         sii_fields = {'sii_book_key', 'sii_operation_key', 'sii_received_key',
             'sii_issued_key', 'sii_state', 'sii_pending_sending',
-            'sii_communication_type', 'sii_header'}
+            'sii_communication_type', 'sii_header', 'sii_header_digest'}
         cls._check_modify_exclude |= sii_fields
         if hasattr(cls, '_intercompany_excluded_fields'):
             cls._intercompany_excluded_fields += sii_fields
@@ -63,9 +67,14 @@ class Invoice(metaclass=PoolMeta):
         exist_sii_intracomunity_key = table.column_exist('sii_intracomunity_key')
         exist_sii_subjected_key = table.column_exist('sii_subjected_key')
         exist_sii_excemption_key = table.column_exist('sii_excemption_key')
+        exist_sii_header_digest = table.column_exist('sii_header_digest')
 
         super(Invoice, cls).__register__(module_name)
 
+        if not exist_sii_header_digest:
+            tools.migrate_headers(Transaction().connection.cursor(),
+                cls.__table__())
+
         if exist_sii_intracomunity_key:
             table.drop_column('sii_intracomunity_key')
         if exist_sii_subjected_key:
@@ -73,6 +82,19 @@ class Invoice(metaclass=PoolMeta):
         if exist_sii_excemption_key:
             table.drop_column('sii_excemption_key')
 
+    @classmethod
+    def create(cls, vlist):
+        vlist = [tools.with_header_digest(v) for v in vlist]
+        return super(Invoice, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for invoices, values in zip(actions, actions):
+            args.extend((invoices, tools.with_header_digest(values)))
+        super(Invoice, cls).write(*args)
+
     @staticmethod
     def default_sii_pending_sending():
         return False
@@ -115,6 +137,7 @@ class Invoice(metaclass=PoolMeta):
         default.setdefault('sii_operation_key')
         default.setdefault('sii_pending_sending')
         default.setdefault('sii_header')
+        default.setdefault('sii_header_digest')
         return super(Invoice, cls).copy(records, default=default)
 
     def _get_sii_operation_key(self):
@@ -193,6 +216,8 @@ class Invoice(metaclass=PoolMeta):
         # Suejta-Exenta --> Can only be one
         # NoSujeta --> Can only be one
 
+        to_header = [i for i in invoices2checksii if i.sii_book_key]
+        headers = dict(zip(to_header, cls.get_sii_headers(to_header, False)))
         for invoice in invoices2checksii:
             values = {}
             if invoice.sii_book_key:
@@ -200,7 +225,7 @@ class Invoice(metaclass=PoolMeta):
                     values['sii_operation_key'] =\
                         invoice._get_sii_operation_key()
                 values['sii_pending_sending'] = True
-                values['sii_header'] = str(cls.get_sii_header(invoice, False))
+                values['sii_header'] = tools.dumps_header(headers[invoice])
                 to_write.extend(([invoice], values))
             for tax in invoice.taxes:
                 if (tax.tax.sii_subjected_key in ('S2', 'S3') and
@@ -218,22 +243,44 @@ class Invoice(metaclass=PoolMeta):
 
     @classmethod
     def get_sii_header(cls, invoice, delete):
+        header, = cls.get_sii_headers([invoice], delete)
+        return header
+
+    @classmethod
+    def get_sii_headers(cls, invoices, delete):
+        '''
+        Return the SII headers of invoices in the same order.
+
+        The headers of invoices are built in batches by the mapper of their
+        type and the errors of all of them are raised together.
+        '''
         pool = Pool()
         IssuedMapper = pool.get('aeat.sii.issued.invoice.mapper')
         ReceivedMapper = pool.get('aeat.sii.recieved.invoice.mapper')
 
-        if delete:
-            rline = [x for x in invoice.sii_records if x.state == 'Correcto'
-                and x.sii_header != None]
-            if rline:
-                return rline[0].sii_header
-        if invoice.type == 'out':
-            mapper = IssuedMapper()
-            header = mapper.build_delete_request(invoice)
-        else:
-            mapper = ReceivedMapper()
-            header = mapper.build_delete_request(invoice)
-        return header
+        headers = [None] * len(invoices)
+        to_map = {'out': [], 'in': []}
+        for i, invoice in enumerate(invoices):
+            if delete:
+                rline = [x for x in invoice.sii_records
+                    if x.state == 'Correcto' and x.sii_header != None]
+                if rline:
+                    headers[i] = tools.loads_header(rline[0].sii_header)
+                    continue
+            to_map['out' if invoice.type == 'out' else 'in'].append(i)
+
+        errors = []
+        for type_, Mapper in [('out', IssuedMapper), ('in', ReceivedMapper)]:
+            indexes = to_map[type_]
+            if not indexes:
+                continue
+            requests, errs = Mapper().build_delete_requests(
+                [invoices[i] for i in indexes])
+            for i, request in zip(indexes, requests):
+                headers[i] = request
+            errors.extend(errs)
+        raise_errors(errors)
+        return headers
 
 
 class ResetSIIKeysStart(ModelView):
@@ -1,12 +1,41 @@
+import asyncio
+import hashlib
+import os
+import secrets
+import ssl
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
 from logging import getLogger
-from requests import Session
+from tempfile import NamedTemporaryFile
+from threading import Lock, Semaphore
+from urllib.parse import urljoin
+from requests import Session, certs
+from requests.adapters import HTTPAdapter
+from lxml import etree
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
-from zeep import Client
-from zeep.transports import Transport
-from zeep.plugins import HistoryPlugin
+from zeep import Client, AsyncClient
+from zeep.cache import SqliteCache
+from zeep.proxy import AsyncServiceProxy
+from zeep.transports import Transport, AsyncTransport
+from zeep.exceptions import TransportError
+from zeep.plugins import HistoryPlugin, apply_egress, apply_ingress
+from zeep.wsdl.messages.base import SerializedMessage
+from zeep.wsdl.utils import etree_to_string
 
+from trytond.cache import LRUDict
+from trytond.config import config
 from trytond.pool import Pool
-from .tools import LoggingPlugin
+from . import envelope
+from .aeat_mapping import raise_errors
+from .tools import LoggingPlugin, SessionIdPlugin
 
 _logger = getLogger(__name__)
 
@@ -15,115 +44,578 @@ wsdl_prod = ('https://www2.agenciatributaria.gob.es/static_files/common/'
 wsdl_test = ('https://www6.aeat.es/static_files/common/internet/dep/'
     'aplicaciones/es/aeat/ssii_1_1_bis/fact/ws/')
 
+# Local copy of the ssii_1_1_bis WSDL and XSD files, see fetch_wsdl()
+WSDL_PATH = config.get('aeat', 'sii_wsdl_path',
+    default=os.path.join(os.path.dirname(__file__), 'wsdl'))
+WSDL_CACHE_TIMEOUT = config.getint('aeat', 'sii_wsdl_cache_timeout',
+    default=30 * 24 * 60 * 60)
+_wsdl_cache = None
 
-def _get_client(wsdl, public_crt, private_key, test=False):
+# Address that replaces the one of the WSDL, e.g. a local stand-in server
+ENDPOINT = config.get('aeat', 'sii_endpoint', default=None)
+
+# Bound services are kept per (wsdl, port, certificate, test) so the WSDL and
+# its XSD tree are only parsed once per worker
+CLIENT_CACHE_SIZE = config.getint('aeat', 'sii_client_cache', default=16)
+_clients = LRUDict(CLIENT_CACHE_SIZE)
+_clients_lock = Lock()
+
+# HTTPS sessions are kept per certificate and shared by all its clients so
+# keep-alive connections survive between reports and cron runs
+POOL_SIZE = config.getint('aeat', 'sii_pool_size', default=4)
+POOL_IDLE_TIMEOUT = config.getint('aeat', 'sii_pool_idle_timeout',
+    default=300)
+CONNECT_TIMEOUT = config.getfloat('aeat', 'sii_connect_timeout', default=10)
+READ_TIMEOUT = config.getfloat('aeat', 'sii_read_timeout', default=300)
+SESSION_TIMEOUT = config.getint('aeat', 'sii_session_timeout', default=900)
+
+# Independent reports can be sent in parallel, bounded per certificate,
+# either from a thread pool or from an asyncio event loop
+SEND_WORKERS = config.getint('aeat', 'sii_send_workers', default=1)
+SEND_MODE = config.get('aeat', 'sii_send_mode', default='thread')
+CERTIFICATE_WORKERS = config.getint('aeat', 'sii_certificate_workers',
+    default=2)
+_sessions = LRUDict(CLIENT_CACHE_SIZE)
+
+# SSL contexts are kept per company so its private key is only decrypted and
+# loaded again when they expire or its credentials change
+SSL_CONTEXT_TTL = config.getint('aeat', 'sii_ssl_context_ttl', default=3600)
+_ssl_contexts = LRUDict(CLIENT_CACHE_SIZE)
+
+# 'zeep' validates and serializes the requests through the WSDL types while
+# 'lxml' builds the SuministroLR and AnulacionLR envelopes straight
+SERIALIZER = config.get('aeat', 'sii_serializer', default='zeep')
+
+# Number of sent and received envelopes kept by the clients, 0 keeps none
+HISTORY_SIZE = config.getint('aeat', 'sii_history', default=0)
+
+
+def certificate_fingerprint(pem_certificate):
+    return hashlib.sha256(bytes(pem_certificate)).hexdigest()
+
+
+def invalidate_clients(pem_certificate=None):
+    "Drop the cached clients of the certificate or all of them if None"
+    with _clients_lock:
+        if pem_certificate is None:
+            entries = list(_sessions.values())
+            _clients.clear()
+            _sessions.clear()
+        else:
+            fingerprint = certificate_fingerprint(pem_certificate)
+            for key in [k for k in _clients if k[2] == fingerprint]:
+                del _clients[key]
+            entries = [_sessions.pop(fingerprint, None)]
+    for entry in filter(None, entries):
+        entry[0].close()
+
+
+class _SSLContextAdapter(HTTPAdapter):
+    "HTTP adapter that authenticates with a preloaded SSL context"
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super(_SSLContextAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(_SSLContextAdapter, self).init_poolmanager(
+            *args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(_SSLContextAdapter, self).proxy_manager_for(
+            *args, **kwargs)
+
+
+def create_ssl_context(pem_certificate, private_key):
+    "Return an SSL context that authenticates with the certificate and key"
+    ssl_context = ssl.create_default_context(cafile=certs.where())
+    # load_cert_chain only reads files so the key is written to disk
+    # encrypted with a one time password while the credentials are loaded
+    password = secrets.token_bytes(32)
+    key = serialization.load_pem_private_key(
+        bytes(private_key), None, default_backend())
+    encrypted_key = key.private_bytes(serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.BestAvailableEncryption(password))
+    with NamedTemporaryFile(suffix='.pem') as pem:
+        pem.write(bytes(pem_certificate))
+        pem.write(b'\n')
+        pem.write(encrypted_key)
+        pem.flush()
+        ssl_context.load_cert_chain(pem.name, password=lambda: password)
+    return ssl_context
+
+
+def get_ssl_context(key, credentials, version=None):
+    '''
+    Return the certificate fingerprint and the SSL context cached for key.
+    credentials is called to get the PEM certificate and private key when
+    they are missing, expired or were cached for another version of them.
+    '''
+    now = time.monotonic()
+    with _clients_lock:
+        entry = _ssl_contexts.get(key)
+        if (entry is not None and entry[3] == version
+                and now - entry[2] <= SSL_CONTEXT_TTL):
+            _ssl_contexts.move_to_end(key)
+            return entry[0], entry[1]
+    pem_certificate, private_key = credentials()
+    fingerprint = certificate_fingerprint(pem_certificate)
+    ssl_context = create_ssl_context(pem_certificate, private_key)
+    with _clients_lock:
+        _ssl_contexts[key] = (fingerprint, ssl_context, now, version)
+    return fingerprint, ssl_context
+
+
+def invalidate_ssl_context(key=None):
+    "Drop the cached SSL context of key or all of them if None"
+    with _clients_lock:
+        if key is None:
+            _ssl_contexts.clear()
+        else:
+            _ssl_contexts.pop(key, None)
+
+
+def _get_session(fingerprint, ssl_context):
+    now = time.monotonic()
+    with _clients_lock:
+        entry = _sessions.get(fingerprint)
+        if (entry is not None
+                and entry[0].get_adapter('https://').ssl_context
+                is not ssl_context):
+            # The SSL context has been reloaded
+            entry[0].close()
+            entry = None
+        if entry is None:
+            session = Session()
+            # AEAT session identifiers are replayed by SessionIdPlugin
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            session.mount('https://', _SSLContextAdapter(ssl_context,
+                    pool_connections=1, pool_maxsize=POOL_SIZE))
+            entry = _sessions[fingerprint] = [session, now]
+        elif now - entry[1] > POOL_IDLE_TIMEOUT:
+            # Drop connections the server has most likely closed already
+            entry[0].close()
+        entry[1] = now
+        _sessions.move_to_end(fingerprint)
+    return entry[0]
+
+
+def session_stats():
+    "Return the AEAT session reuse counters of the cached clients"
+    stats = {'created': 0, 'reused': 0, 'expired': 0}
+    with _clients_lock:
+        clients = [client for client, _ in _clients.values()]
+    for client in clients:
+        for plugin in client.plugins:
+            if isinstance(plugin, SessionIdPlugin):
+                for key, value in plugin.stats().items():
+                    stats[key] += value
+    return stats
+
+
+def _wsdl_location(filename, test=False):
+    local = os.path.join(WSDL_PATH, filename)
+    if os.path.isfile(local):
+        return local
+    _logger.warning('Missing local %s, loading it from AEAT', filename)
+    return (wsdl_test if test else wsdl_prod) + filename
+
+
+def _get_wsdl_cache():
+    global _wsdl_cache
+    if _wsdl_cache is None:
+        path = config.get('database', 'path')
+        if not path or not os.path.isdir(path):
+            return None
+        _wsdl_cache = SqliteCache(
+            path=os.path.join(path, 'aeat_sii_wsdl.db'),
+            timeout=WSDL_CACHE_TIMEOUT)
+    return _wsdl_cache
+
+
+def fetch_wsdl(directory=WSDL_PATH, test=False):
+    "Download the SII WSDL files and the XSD they import into directory"
     session = Session()
-    session.cert = (public_crt, private_key)
-    transport = Transport(session=session)
-    plugins = [HistoryPlugin()]
-    # TODO: manually handle sessionId? Not mandatory yet recommended...
+    base = wsdl_test if test else wsdl_prod
+    pending = [base + 'SuministroFactEmitidas.wsdl',
+        base + 'SuministroFactRecibidas.wsdl']
+    fetched = set()
+    os.makedirs(directory, exist_ok=True)
+    while pending:
+        url = pending.pop()
+        filename = os.path.basename(url)
+        if filename in fetched:
+            continue
+        fetched.add(filename)
+        response = session.get(url, timeout=60)
+        response.raise_for_status()
+        tree = etree.fromstring(response.content)
+        # Rewrite imports to the file name so they are resolved locally
+        for node in tree.xpath('//*[local-name()="import" '
+                'or local-name()="include"]'):
+            attribute = ('schemaLocation' if 'schemaLocation' in node.attrib
+                else 'location')
+            location = node.get(attribute)
+            if not location:
+                continue
+            node.set(attribute, os.path.basename(location))
+            pending.append(urljoin(url, location))
+        with open(os.path.join(directory, filename), 'wb') as local:
+            local.write(etree.tostring(tree, xml_declaration=True,
+                    encoding='UTF-8'))
+    return sorted(fetched)
+
+
+def _get_client(wsdl, session, test=False):
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    transport = Transport(session=session, cache=_get_wsdl_cache(),
+        timeout=timeout, operation_timeout=timeout)
     # http://www.agenciatributaria.es/AEAT.internet/Inicio/Ayuda/Modelos__Procedimientos_y_Servicios/Ayuda_P_G417____IVA__Llevanza_de_libros_registro__SII_/Ayuda_tecnica/Informacion_tecnica_SII/Preguntas_tecnicas_frecuentes/1__Cuestiones_Generales/16___Como_se_debe_utilizar_el_dato_sesionId__.shtml
+    plugins = [SessionIdPlugin(timeout=SESSION_TIMEOUT)]
+    if HISTORY_SIZE:
+        plugins.append(HistoryPlugin(maxlen=HISTORY_SIZE))
     if test:
         plugins.append(LoggingPlugin())
     client = Client(wsdl=wsdl, transport=transport, plugins=plugins)
     return client
 
 
-def bind_issued_invoices_service(crt, pkey, test=False):
-    wsdl = wsdl_prod + 'SuministroFactEmitidas.wsdl'
+def _bind(wsdl, port_name, fingerprint, ssl_context, test=False):
+    session = _get_session(fingerprint, ssl_context)
+    key = (wsdl, port_name, fingerprint, test)
+    with _clients_lock:
+        cached = _clients.get(key)
+        if cached is not None:
+            _clients.move_to_end(key)
+    if cached is not None:
+        client, service = cached
+        # The session is replaced when the SSL context is reloaded
+        client.transport.session = session
+        return service, fingerprint
+
+    client = _get_client(wsdl, session, test)
+    service = client.bind('siiService', port_name)
+    if ENDPOINT:
+        service._binding_options['address'] = ENDPOINT
+    with _clients_lock:
+        _clients[key] = (client, service)
+    return service, fingerprint
+
+
+def bind_issued_invoices_service(fingerprint, ssl_context, test=False):
+    wsdl = _wsdl_location('SuministroFactEmitidas.wsdl', test)
     port_name = 'SuministroFactEmitidas'
     if test:
-        wsdl = wsdl_test + 'SuministroFactEmitidas.wsdl'
         port_name += 'Pruebas'
 
-    cli = _get_client(wsdl, crt, pkey, test)
-
-    return _IssuedInvoiceService(
-        cli.bind('siiService', port_name))
+    return _IssuedInvoiceService(*_bind(wsdl, port_name, fingerprint,
+            ssl_context, test))
 
 
-def bind_recieved_invoices_service(crt, pkey, test=False):
-    wsdl = wsdl_prod + 'SuministroFactRecibidas.wsdl'
+def bind_recieved_invoices_service(fingerprint, ssl_context, test=False):
+    wsdl = _wsdl_location('SuministroFactRecibidas.wsdl', test)
     port_name = 'SuministroFactRecibidas'
     if test:
-        wsdl = wsdl_test + 'SuministroFactRecibidas.wsdl'
         port_name += 'Pruebas'
 
-    cli = _get_client(wsdl, crt, pkey, test)
+    return _RecievedInvoiceService(*_bind(wsdl, port_name, fingerprint,
+            ssl_context, test))
+
+
+def call_concurrently(calls, workers=None):
+    '''
+    Run the (service, method name, arguments) calls concurrently.
+    Return a (result, exception) pair for each call in the same order.
+    The calls must only do network I/O as they run outside the transaction.
+    '''
+    workers = workers or SEND_WORKERS
+    if SEND_MODE == 'async' and httpx is not None:
+        return asyncio.run(_call_asynchronously(calls, workers))
+    elif SEND_MODE == 'async':
+        _logger.warning('httpx is required by the async SII send mode')
+
+    semaphores = defaultdict(lambda: Semaphore(CERTIFICATE_WORKERS))
+    for srv, _, _ in calls:
+        semaphores[srv.fingerprint]
+
+    def call(srv, method, args):
+        with semaphores[srv.fingerprint]:
+            try:
+                return getattr(srv, method)(*args), None
+            except Exception as e:
+                return None, e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(call, *c) for c in calls]
+        return [f.result() for f in futures]
+
+
+async def _call_asynchronously(calls, workers):
+    limit = asyncio.Semaphore(workers)
+    semaphores = defaultdict(lambda: asyncio.Semaphore(CERTIFICATE_WORKERS))
+    # The services bound to the same certificate share the connection pool
+    transports = {}
+    services = {}
+    for srv, _, _ in calls:
+        if srv.fingerprint not in transports:
+            transports[srv.fingerprint] = _async_transport(srv)
+        key = (srv.fingerprint, type(srv))
+        if key not in services:
+            services[key] = _AsyncInvoiceService(srv,
+                transports[srv.fingerprint])
+
+    async def call(srv, method, args):
+        async with limit, semaphores[srv.fingerprint]:
+            try:
+                async_service = services[(srv.fingerprint, type(srv))]
+                return await getattr(async_service, method)(*args), None
+            except Exception as e:
+                return None, e
+
+    try:
+        return await asyncio.gather(*(call(*c) for c in calls))
+    finally:
+        for transport in transports.values():
+            await transport.aclose()
+            transport.wsdl_client.close()
 
-    return _RecievedInvoiceService(
-        cli.bind('siiService', port_name))
 
+def _prepare_message(service, operation, headers, body):
+    "Return the operation, the envelope bytes and the HTTP headers to post"
+    client = service._client
+    binding = service._binding
+    operation_obj = binding.get(operation)
+    if SERIALIZER != 'lxml':
+        envelope_, http_headers = binding._create(operation, (headers, body),
+            {}, client=client, options=service._binding_options)
+        return operation_obj, etree_to_string(envelope_), http_headers
 
-class _IssuedInvoiceService(object):
-    def __init__(self, service):
+    message = SerializedMessage(path=None,
+        headers={'SOAPAction': '"%s"' % (operation_obj.soapaction or '')},
+        content=envelope.build_envelope(operation, headers, body))
+    binding._set_http_headers(message, operation_obj)
+    envelope_, http_headers = apply_egress(client, message.content,
+        message.headers, operation_obj, service._binding_options)
+    if client.settings.extra_http_headers:
+        http_headers.update(client.settings.extra_http_headers)
+    return operation_obj, etree_to_string(envelope_), http_headers
+
+
+def _send_operation(service, operation, headers, body):
+    "Call the operation and return its result and the envelope bytes sent"
+    operation_obj, message, http_headers = _prepare_message(service,
+        operation, headers, body)
+    response = service._client.transport.post(
+        service._binding_options['address'], message, http_headers)
+    return service._binding.process_reply(service._client, operation_obj,
+        response), message
+
+
+async def _send_operation_async(service, operation, headers, body):
+    operation_obj, message, http_headers = _prepare_message(service,
+        operation, headers, body)
+    transport = service._client.transport
+    response = transport.new_response(await transport.post(
+            service._binding_options['address'], message, http_headers))
+    return service._binding.process_reply(service._client, operation_obj,
+        response), message
+
+
+def _to_dict(element):
+    if not len(element):
+        return element.text
+    return {etree.QName(c).localname: _to_dict(c) for c in element}
+
+
+class _QueryResponse(object):
+    '''
+    Registers of a ConsultaLR response parsed while they are downloaded.
+
+    Iterating it yields each register element, which is cleared once the next
+    one is requested so memory does not grow with the size of the page.
+    pagination and last_invoice are set when it is exhausted and ingress is
+    called with the envelope, which keeps all but the registers.
+    '''
+
+    def __init__(self, response, register, ingress=None):
+        self.response = response
+        self.register = register
+        self.ingress = ingress
+        self.pagination = None
+        self.last_invoice = None
+        self.count = 0
+
+    def __iter__(self):
+        self.response.raw.decode_content = True
+        try:
+            events = etree.iterparse(self.response.raw, events=('end',),
+                tag=('{*}IndicadorPaginacion', '{*}' + self.register))
+            for _, element in events:
+                if etree.QName(element).localname == 'IndicadorPaginacion':
+                    self.pagination = element.text
+                    continue
+                self.count += 1
+                self.last_invoice = _to_dict(element.find('{*}IDFactura'))
+                yield element
+                element.clear()
+                for previous in list(element.itersiblings(element.tag,
+                            preceding=True)):
+                    element.getparent().remove(previous)
+            if self.ingress:
+                self.ingress(events.root)
+        finally:
+            self.response.close()
+        _logger.debug('%s %s registers, pagination: %s', self.count,
+            self.register, self.pagination)
+
+
+def _stream_operation(service, operation, headers, filter_, register):
+    "Post the query and return its registers parsed while downloaded"
+    client = service._client
+    operation_obj = service._binding.get(operation)
+    envelope_, http_headers = service._binding._create(operation,
+        (headers, filter_), {}, client=client,
+        options=service._binding_options)
+    response = client.transport.session.post(
+        service._binding_options['address'], data=etree.tostring(envelope_),
+        headers=http_headers, timeout=client.transport.operation_timeout,
+        stream=True)
+    if response.status_code != 200:
+        # The fault is small so it is read whole, process_reply applies the
+        # plugins and raises it
+        service._binding.process_reply(client, operation_obj, response)
+        raise TransportError('Server returned HTTP status %d'
+            % response.status_code, status_code=response.status_code,
+            content=response.content)
+
+    def ingress(envelope):
+        apply_ingress(client, envelope, response.headers, operation_obj)
+    return _QueryResponse(response, register, ingress=ingress)
+
+
+class _InvoiceService(object):
+    mapper = None
+    submit_operation = None
+    cancel_operation = None
+    query_operation = None
+    query_register = None
+
+    def __init__(self, service, fingerprint=None):
         self.service = service
+        self.fingerprint = fingerprint
+
+    def _get_mapper(self):
+        return Pool().get(self.mapper)()
+
+    def build_submit_request(self, invoices):
+        mapper = self._get_mapper()
+        request, errors = mapper.build_submit_requests(list(invoices))
+        raise_errors(errors)
+        return request
+
+    def build_query_filter(self, year=None, period=None, last_invoice=None):
+        mapper = self._get_mapper()
+        return mapper.build_query_filter(year=year, period=period,
+            last_invoice=last_invoice)
 
     def submit(self, headers, invoices):
-        pool = Pool()
-        IssuedMapper = pool.get('aeat.sii.issued.invoice.mapper')
-        mapper = IssuedMapper()
+        return self.submit_request(headers,
+            self.build_submit_request(invoices))
 
-        body = [mapper.build_submit_request(i) for i in invoices]
+    def submit_request(self, headers, body):
         _logger.debug(body)
-        response_ = self.service.SuministroLRFacturasEmitidas(
-            headers, body)
+        response_, message = _send_operation(self.service,
+            self.submit_operation, headers, body)
         _logger.debug(response_)
-        return response_, str(body)
+        return response_, message
 
     def cancel(self, headers, body):
         _logger.debug(body)
-        response_ = self.service.AnulacionLRFacturasEmitidas(
+        response_, _ = _send_operation(self.service, self.cancel_operation,
             headers, body)
         _logger.debug(response_)
         return response_
 
     def query(self, headers, year=None, period=None, last_invoice=None):
-        pool = Pool()
-        IssuedMapper = pool.get('aeat.sii.issued.invoice.mapper')
-        mapper = IssuedMapper()
+        return self.query_request(headers, self.build_query_filter(
+                year=year, period=period, last_invoice=last_invoice))
 
-        filter_ = mapper.build_query_filter(year=year, period=period,
-            last_invoice=last_invoice)
+    def query_request(self, headers, filter_):
         _logger.debug(filter_)
-        response_ = self.service.ConsultaLRFacturasEmitidas(
+        response_ = getattr(self.service, self.query_operation)(
             headers, filter_)
         _logger.debug(response_)
         return response_
 
+    def query_stream(self, headers, year=None, period=None,
+            last_invoice=None):
+        filter_ = self.build_query_filter(year=year, period=period,
+            last_invoice=last_invoice)
+        _logger.debug(filter_)
+        return _stream_operation(self.service, self.query_operation, headers,
+            filter_, self.query_register)
 
-class _RecievedInvoiceService(object):
-    def __init__(self, service):
-        self.service = service
 
-    def submit(self, headers, invoices):
-        pool = Pool()
-        ReceivedMapper = pool.get('aeat.sii.recieved.invoice.mapper')
-        mapper = ReceivedMapper()
+class _IssuedInvoiceService(_InvoiceService):
+    mapper = 'aeat.sii.issued.invoice.mapper'
+    submit_operation = 'SuministroLRFacturasEmitidas'
+    cancel_operation = 'AnulacionLRFacturasEmitidas'
+    query_operation = 'ConsultaLRFacturasEmitidas'
+    query_register = 'RegistroRespuestaConsultaLRFacturasEmitidas'
 
-        body = [mapper.build_submit_request(i) for i in invoices]
-        _logger.debug(body)
-        response_ = self.service.SuministroLRFacturasRecibidas(
-            headers, body)
-        _logger.debug(response_)
-        return response_, str(body)
 
-    def cancel(self, headers, body):
+class _RecievedInvoiceService(_InvoiceService):
+    mapper = 'aeat.sii.recieved.invoice.mapper'
+    submit_operation = 'SuministroLRFacturasRecibidas'
+    cancel_operation = 'AnulacionLRFacturasRecibidas'
+    query_operation = 'ConsultaLRFacturasRecibidas'
+    query_register = 'RegistroRespuestaConsultaLRFacturasRecibidas'
+
+
+def _async_transport(srv):
+    "Return an asynchronous transport with the SSL context of the service"
+    ssl_context = srv.service._client.transport.session.get_adapter(
+        'https://').ssl_context
+    # The WSDL is already parsed so the synchronous client of the transport
+    # never connects, it is closed along with the transport
+    return AsyncTransport(client=httpx.AsyncClient(
+            verify=ssl_context,
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=POOL_SIZE,
+                keepalive_expiry=POOL_IDLE_TIMEOUT)),
+        wsdl_client=httpx.Client(verify=ssl_context))
+
+
+class _AsyncInvoiceService(object):
+    '''
+    Asynchronous counterpart of the submissions and cancellations of a bound
+    service.
+    It reuses the parsed WSDL and plugins of the synchronous one.
+    The queries are not part of it as their pages are requested one after
+    the other and streamed by the synchronous service.
+    '''
+
+    def __init__(self, srv, transport):
+        client = srv.service._client
+        async_client = AsyncClient(client.wsdl, transport=transport,
+            plugins=client.plugins)
+        self.service = AsyncServiceProxy(async_client, srv.service._binding,
+            **srv.service._binding_options)
+        self.srv = srv
+
+    async def submit_request(self, headers, body):
         _logger.debug(body)
-        response_ = self.service.AnulacionLRFacturasRecibidas(
-            headers, body)
+        response_, message = await _send_operation_async(self.service,
+            self.srv.submit_operation, headers, body)
         _logger.debug(response_)
-        return response_
+        return response_, message
 
-    def query(self, headers, year=None, period=None, last_invoice=None):
-        pool = Pool()
-        ReceivedMapper = pool.get('aeat.sii.recieved.invoice.mapper')
-        mapper = ReceivedMapper()
-
-        filter_ = mapper.build_query_filter(year=year, period=period,
-            last_invoice=last_invoice)
-        _logger.debug(filter_)
-        response_ = self.service.ConsultaLRFacturasRecibidas(
-            headers, filter_)
+    async def cancel(self, headers, body):
+        _logger.debug(body)
+        response_, _ = await _send_operation_async(self.service,
+            self.srv.cancel_operation, headers, body)
         _logger.debug(response_)
         return response_
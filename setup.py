@@ -74,7 +74,8 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     package_data={
         'trytond.modules.%s' % MODULE: (info.get('xml', [])
-            + ['tryton.cfg', 'view/*.xml', 'locale/*.po', 'tests/*.rst']),
+            + ['tryton.cfg', 'view/*.xml', 'locale/*.po', 'tests/*.rst',
+                'wsdl/*.wsdl', 'wsdl/*.xsd']),
         },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Time the creation of the SII books of the pending invoices of a database.
+
+The invoices are classified and their reports and lines created as the
+calculate_sii cron does, then the transaction is rolled back so it can be
+run again on the same data, for example a copy of a database with 50000
+pending invoices::
+
+    python -m trytond.modules.aeat_sii.tests.benchmark_create_book \
+        -c trytond.conf -d sii_50k --company 1
+'''
+import argparse
+import time
+
+from trytond.config import config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('--company', type=int, required=True)
+    parser.add_argument('--book', choices=['E', 'R'], default='E')
+    args = parser.parse_args()
+
+    config.update_etc(args.config)
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(args.database)
+    pool.init()
+
+    with Transaction().start(args.database, 0,
+            context={'company': args.company}) as transaction:
+        SIIReport = pool.get('aeat.sii.report')
+        type_ = 'out' if args.book == 'E' else 'in'
+
+        start = time.perf_counter()
+        pending = SIIReport._get_pending_sii_invoices(type_)
+        classified = time.perf_counter()
+        reports = SIIReport.create_sii_book(pending, args.book)
+        created = time.perf_counter()
+        transaction.rollback()
+
+        count = {o: sum(len(i) for i in p.values())
+            for o, p in pending.items()}
+        print('A0: %s, A1: %s, D0: %s invoices in %s reports: '
+            'classification %.2f s, book creation %.2f s' % (
+                count['A0'], count['A1'], count['D0'], len(reports),
+                classified - start, created - classified))
+
+
+if __name__ == '__main__':
+    main()
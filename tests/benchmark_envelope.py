@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Compare the zeep and lxml serializers of the SuministroLR envelopes.
+
+Both serializers build the envelope of the same synthetic blocks of issued
+and received invoices. The zeep one needs the ssii_1_1_bis WSDL, see
+service.fetch_wsdl(), without it only the lxml one is timed::
+
+    python -m trytond.modules.aeat_sii.tests.benchmark_envelope --invoices 300
+'''
+import argparse
+import timeit
+from decimal import Decimal
+
+from lxml import etree
+from zeep import Client
+
+from trytond.modules.aeat_sii import envelope, service
+
+HEADER = {
+    'IDVersionSii': '1.1',
+    'Titular': {
+        'NombreRazon': 'EMPRESA DE PRUEBAS',
+        'NIF': 'B00000000',
+        },
+    'TipoComunicacion': 'A0',
+    }
+
+
+def _invoice_id(i, issuer):
+    return {
+        'IDEmisorFactura': issuer,
+        'NumSerieFacturaEmisor': 'FV2017/%06d' % i,
+        'FechaExpedicionFacturaEmisor': '01-01-2017',
+        }
+
+
+def _tax(kind, rate):
+    base = Decimal('100.00')
+    return {
+        'TipoImpositivo': rate,
+        'BaseImponible': base,
+        kind: (base * rate / 100).quantize(Decimal('0.01')),
+        }
+
+
+def issued_invoices(count):
+    return [{
+            'PeriodoLiquidacion': {'Ejercicio': 2017, 'Periodo': '01'},
+            'IDFactura': _invoice_id(i, {'NIF': 'B00000000'}),
+            'FacturaExpedida': {
+                'TipoFactura': 'F1',
+                'ClaveRegimenEspecialOTrascendencia': '01',
+                'ImporteTotal': Decimal('331.00'),
+                'DescripcionOperacion': 'FV2017/%06d' % i,
+                'TipoDesglose': {
+                    'DesgloseFactura': {
+                        'Sujeta': {
+                            'NoExenta': {
+                                'TipoNoExenta': 'S1',
+                                'DesgloseIVA': {
+                                    'DetalleIVA': [
+                                        _tax('CuotaRepercutida', rate)
+                                        for rate in (Decimal('21'),
+                                            Decimal('10'))],
+                                    },
+                                },
+                            },
+                        },
+                    },
+                'Contraparte': {
+                    'NombreRazon': 'CLIENTE %s' % i,
+                    'NIF': 'B%08d' % i,
+                    },
+                },
+            } for i in range(count)]
+
+
+def received_invoices(count):
+    return [{
+            'PeriodoLiquidacion': {'Ejercicio': 2017, 'Periodo': '01'},
+            'IDFactura': _invoice_id(i, {
+                    'NombreRazon': 'PROVEEDOR %s' % i,
+                    'NIF': 'B%08d' % i,
+                    }),
+            'FacturaRecibida': {
+                'TipoFactura': 'F1',
+                'ClaveRegimenEspecialOTrascendencia': '01',
+                'ImporteTotal': Decimal('331.00'),
+                'DescripcionOperacion': 'FC2017/%06d' % i,
+                'DesgloseFactura': {
+                    'DesgloseIVA': {
+                        'DetalleIVA': [
+                            dict(_tax('CuotaSoportada', rate),
+                                BienInversion='N')
+                            for rate in (Decimal('21'), Decimal('10'))],
+                        },
+                    },
+                'Contraparte': {
+                    'NombreRazon': 'PROVEEDOR %s' % i,
+                    'NIF': 'B%08d' % i,
+                    },
+                'FechaRegContable': '31-01-2017',
+                'CuotaDeducible': Decimal('31.00'),
+                },
+            } for i in range(count)]
+
+
+def _normalize(element):
+    "Return the element tree without prefixes nor whitespace"
+    return (element.tag, (element.text or '').strip(),
+        [_normalize(c) for c in element if isinstance(c.tag, str)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--invoices', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    for wsdl, port, operation, invoices in [
+            ('SuministroFactEmitidas.wsdl', 'SuministroFactEmitidas',
+                'SuministroLRFacturasEmitidas', issued_invoices),
+            ('SuministroFactRecibidas.wsdl', 'SuministroFactRecibidas',
+                'SuministroLRFacturasRecibidas', received_invoices),
+            ]:
+        body = invoices(args.invoices)
+
+        def lxml_envelope():
+            return etree.tostring(envelope.build_envelope(operation,
+                    HEADER, body))
+
+        lxml_time = min(timeit.repeat(lxml_envelope, number=1,
+                repeat=args.repeat))
+        try:
+            client = Client(service._wsdl_location(wsdl))
+        except Exception as e:
+            print('%s, %s invoices: lxml %.1f ms, zeep not timed: %s' % (
+                    operation, args.invoices, lxml_time * 1000, e))
+            continue
+        proxy = client.bind('siiService', port)
+
+        def zeep_envelope():
+            return etree.tostring(client.create_message(proxy, operation,
+                    HEADER, body))
+
+        equal = (_normalize(etree.fromstring(zeep_envelope()))
+            == _normalize(etree.fromstring(lxml_envelope())))
+        zeep_time = min(timeit.repeat(zeep_envelope, number=1,
+                repeat=args.repeat))
+        print('%s, %s invoices: zeep %.1f ms, lxml %.1f ms (x%.1f), '
+            'identical: %s' % (operation, args.invoices, zeep_time * 1000,
+                lxml_time * 1000, zeep_time / lxml_time, equal))
+
+
+if __name__ == '__main__':
+    main()
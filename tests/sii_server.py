@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Local stand-in for the AEAT SII web services.
+
+It answers SuministroLRFacturas*, AnulacionLRFacturas* and ConsultaLRFacturas*
+requests with configurable latency, registration errors, partial acceptance,
+technical faults and pagination so report sending and query ingestion can be
+exercised and benchmarked offline. Point the module to it with::
+
+    [aeat]
+    sii_endpoint = http://127.0.0.1:8080/
+
+and start it with::
+
+    python -m trytond.modules.aeat_sii.tests.sii_server --port 8080
+'''
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lxml import etree
+
+from trytond.modules.aeat_sii.tools import NAMESPACES, SOAP_NAMESPACE
+
+_TIMESTAMP_FMT = '%d-%m-%Y %H:%M:%S'
+
+# Registration error codes and the state they leave the register in
+ERROR_MESSAGES = {
+    1100: 'Valor o tipo incorrecto del campo',
+    1104: 'Valor del campo ID incorrecto',
+    2011: 'El NIF de la contraparte no esta identificado',
+    3000: 'Registro de factura duplicado',
+    3001: 'El registro de factura ya ha sido dado de baja',
+    4102: 'El XML no cumple el esquema',
+    4104: 'Error en la cabecera',
+    }
+
+
+def _qname(prefix, name):
+    return '{%s}%s' % (NAMESPACES[prefix], name)
+
+
+def _localname(element):
+    return etree.QName(element).localname
+
+
+def _child(element, name):
+    for child in element:
+        if _localname(child) == name:
+            return child
+
+
+def _text(element, *path):
+    for name in path:
+        if element is None:
+            return None
+        element = _child(element, name)
+    return element.text if element is not None else None
+
+
+def _invoice_key(id_factura):
+    issuer = _child(id_factura, 'IDEmisorFactura')
+    return (
+        _text(issuer, 'NIF') or _text(issuer, 'IDOtro', 'ID'),
+        _text(id_factura, 'NumSerieFacturaEmisor'),
+        _text(id_factura, 'FechaExpedicionFacturaEmisor'),
+        )
+
+
+class SIIStandIn(object):
+    '''
+    In-memory AEAT SII.
+
+    latency: seconds slept for every request.
+    record_latency: seconds slept for every register of a request.
+    errors: maps invoice numbers to the registration error code returned.
+    reject_ratio: share of the registers randomly rejected with code 1100.
+    fault_ratio: share of the requests answered with a technical SOAP fault.
+    page_size: maximum number of registers of a query response.
+    '''
+
+    def __init__(self, latency=0, record_latency=0, errors=None,
+            reject_ratio=0, fault_ratio=0, fault_code=4102, page_size=10000,
+            seed=None):
+        self.latency = latency
+        self.record_latency = record_latency
+        self.errors = errors or {}
+        self.reject_ratio = reject_ratio
+        self.fault_ratio = fault_ratio
+        self.fault_code = fault_code
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.requests = 0
+        # (titular, book) -> {invoice key: (period, IDFactura, Factura)}
+        self.registers = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def seed(self, nif, book, year, period, count):
+        "Register count synthetic invoices of the titular to be queried"
+        registers = self.registers[(nif, book)]
+        for i in range(count):
+            number = 'SEED%s%02d/%06d' % (year, period, i)
+            id_factura = etree.Element(_qname('siiLR', 'IDFactura'))
+            issuer = etree.SubElement(id_factura,
+                _qname('sii', 'IDEmisorFactura'))
+            etree.SubElement(issuer, _qname('sii', 'NIF')).text = (
+                nif if book == 'E' else 'B%08d' % i)
+            etree.SubElement(id_factura,
+                _qname('sii', 'NumSerieFacturaEmisor')).text = number
+            etree.SubElement(id_factura,
+                _qname('sii', 'FechaExpedicionFacturaEmisor')).text = (
+                '01-%02d-%s' % (period, year))
+            registers[_invoice_key(id_factura)] = (
+                (str(year), '%02d' % period), id_factura,
+                self._synthetic_invoice(book, i))
+
+    def _synthetic_invoice(self, book, i):
+        sii = lambda name: _qname('sii', name)
+        invoice = etree.Element(_qname('siiLR',
+                'FacturaExpedida' if book == 'E' else 'FacturaRecibida'))
+        etree.SubElement(invoice, sii('TipoFactura')).text = 'F1'
+        etree.SubElement(invoice,
+            sii('ClaveRegimenEspecialOTrascendencia')).text = '01'
+        etree.SubElement(invoice, sii('ImporteTotal')).text = '121.00'
+        etree.SubElement(invoice, sii('DescripcionOperacion')).text = (
+            'Factura %s' % i)
+        counterpart = etree.Element(sii('Contraparte'))
+        etree.SubElement(counterpart, sii('NombreRazon')).text = 'Party %s' % i
+        etree.SubElement(counterpart, sii('NIF')).text = 'B%08d' % i
+        detail = etree.Element(sii('DetalleIVA'))
+        etree.SubElement(detail, sii('TipoImpositivo')).text = '21'
+        etree.SubElement(detail, sii('BaseImponible')).text = '100.00'
+        if book == 'E':
+            invoice.append(counterpart)
+            breakdown = etree.SubElement(etree.SubElement(etree.SubElement(
+                        etree.SubElement(invoice, sii('TipoDesglose')),
+                        sii('DesgloseFactura')), sii('Sujeta')),
+                sii('NoExenta'))
+            etree.SubElement(breakdown, sii('TipoNoExenta')).text = 'S1'
+            etree.SubElement(detail, sii('CuotaRepercutida')).text = '21.00'
+            etree.SubElement(breakdown, sii('DesgloseIVA')).append(detail)
+        else:
+            etree.SubElement(detail, sii('CuotaSoportada')).text = '21.00'
+            etree.SubElement(etree.SubElement(invoice,
+                    sii('DesgloseFactura')), sii('DesgloseIVA')).append(
+                detail)
+            invoice.append(counterpart)
+            etree.SubElement(invoice, sii('FechaRegContable')).text = (
+                datetime.now().strftime('%d-%m-%Y'))
+            etree.SubElement(invoice, sii('CuotaDeducible')).text = '21.00'
+        return invoice
+
+    def handle(self, content):
+        "Return the HTTP status and the SOAP envelope answering content"
+        with self._lock:
+            self.requests += 1
+            fault = self.random.random() < self.fault_ratio
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            envelope = etree.fromstring(content)
+            request = next(iter(_child(envelope, 'Body')))
+        except (etree.XMLSyntaxError, TypeError, StopIteration):
+            return 500, self._fault(4102)
+        if fault:
+            return 500, self._fault(self.fault_code)
+
+        operation = _localname(request)
+        header = _child(request, 'Cabecera')
+        titular = _text(header, 'Titular', 'NIF')
+        book = 'E' if operation.endswith('Emitidas') else 'R'
+        if operation.startswith('Suministro'):
+            body = self._submit(request, header, titular, book, False)
+        elif operation.startswith('Anulacion'):
+            body = self._submit(request, header, titular, book, True)
+        elif operation.startswith('Consulta'):
+            body = self._query(request, header, titular, book)
+        else:
+            return 500, self._fault(4102)
+        return 200, self._envelope(body)
+
+    def _envelope(self, body):
+        envelope = etree.Element('{%s}Envelope' % SOAP_NAMESPACE,
+            nsmap={'env': SOAP_NAMESPACE})
+        etree.SubElement(envelope, '{%s}Body' % SOAP_NAMESPACE).append(body)
+        return etree.tostring(envelope, xml_declaration=True,
+            encoding='UTF-8')
+
+    def _fault(self, code):
+        envelope = etree.Element('{%s}Envelope' % SOAP_NAMESPACE,
+            nsmap={'env': SOAP_NAMESPACE})
+        fault = etree.SubElement(etree.SubElement(envelope,
+                '{%s}Body' % SOAP_NAMESPACE), '{%s}Fault' % SOAP_NAMESPACE)
+        etree.SubElement(fault, 'faultcode').text = 'env:Client'
+        etree.SubElement(fault, 'faultstring').text = 'Codigo[%s].%s' % (
+            code, ERROR_MESSAGES.get(code, ''))
+        return etree.tostring(envelope, xml_declaration=True,
+            encoding='UTF-8')
+
+    def _copy_header(self, parent, header):
+        copy = etree.SubElement(parent, _qname(
+                'siiLRRC' if parent.tag.startswith(
+                    '{%s}' % NAMESPACES['siiLRRC']) else 'siiR', 'Cabecera'))
+        for child in header:
+            copy.append(etree.fromstring(etree.tostring(child)))
+
+    def _register_state(self, number, registered, delete):
+        code = self.errors.get(number)
+        if code is None and self.reject_ratio:
+            with self._lock:
+                if self.random.random() < self.reject_ratio:
+                    code = 1100
+        if code is None:
+            if delete and not registered:
+                code = 3001
+            elif not delete and registered:
+                code = 3000
+        if code is None:
+            return 'Correcto', None
+        elif code >= 2000 and code < 3000:
+            return 'AceptadoConErrores', code
+        return 'Incorrecto', code
+
+    def _submit(self, request, header, titular, book, delete):
+        kind = 'Emitidas' if book == 'E' else 'Recibidas'
+        response = etree.Element(_qname('siiR',
+                ('RespuestaLRBajaFacturas%s' if delete
+                    else 'RespuestaLRFacturas%s') % kind),
+            nsmap={'siiR': NAMESPACES['siiR'], 'sii': NAMESPACES['sii']})
+        now = datetime.now()
+        etree.SubElement(response, _qname('siiR', 'CSV')).text = (
+            'SI%s' % now.strftime('%Y%m%d%H%M%S%f'))
+        presentation = etree.SubElement(response,
+            _qname('siiR', 'DatosPresentacion'))
+        etree.SubElement(presentation, _qname('sii', 'NIFPresentador')).text = (
+            titular)
+        etree.SubElement(presentation,
+            _qname('sii', 'TimestampPresentacion')).text = now.strftime(
+                _TIMESTAMP_FMT)
+        self._copy_header(response, header)
+        state = etree.SubElement(response, _qname('siiR', 'EstadoEnvio'))
+
+        registers = self.registers[(titular, book)]
+        accepted = rejected = 0
+        for record in request:
+            if not _localname(record).startswith('RegistroLR'):
+                continue
+            if self.record_latency:
+                time.sleep(self.record_latency)
+            id_factura = _child(record, 'IDFactura')
+            key = _invoice_key(id_factura)
+            with self._lock:
+                state_, code = self._register_state(key[1],
+                    key in registers, delete)
+                if state_ != 'Incorrecto':
+                    if delete:
+                        registers.pop(key, None)
+                    else:
+                        invoice = (_child(record, 'FacturaExpedida')
+                            if book == 'E'
+                            else _child(record, 'FacturaRecibida'))
+                        registers[key] = ((
+                                _text(record, 'PeriodoLiquidacion',
+                                    'Ejercicio'),
+                                _text(record, 'PeriodoLiquidacion',
+                                    'Periodo')),
+                            id_factura, invoice)
+            if state_ == 'Incorrecto':
+                rejected += 1
+            else:
+                accepted += 1
+            line = etree.SubElement(response,
+                _qname('siiR', 'RespuestaLinea'))
+            copy = etree.SubElement(line, _qname('siiR', 'IDFactura'))
+            for child in id_factura:
+                copy.append(etree.fromstring(etree.tostring(child)))
+            etree.SubElement(line, _qname('siiR', 'EstadoRegistro')).text = (
+                state_)
+            if code:
+                etree.SubElement(line,
+                    _qname('siiR', 'CodigoErrorRegistro')).text = str(code)
+                etree.SubElement(line,
+                    _qname('siiR', 'DescripcionErrorRegistro')).text = (
+                    ERROR_MESSAGES.get(code, ''))
+        if not rejected:
+            state.text = 'Correcto'
+        elif accepted:
+            state.text = 'ParcialmenteCorrecto'
+        else:
+            state.text = 'Incorrecto'
+        return response
+
+    def _query(self, request, header, titular, book):
+        kind = 'Emitidas' if book == 'E' else 'Recibidas'
+        filter_ = _child(request, 'FiltroConsulta')
+        period = (_text(filter_, 'PeriodoLiquidacion', 'Ejercicio'),
+            _text(filter_, 'PeriodoLiquidacion', 'Periodo'))
+        with self._lock:
+            keys = sorted(k for k, v in self.registers[(titular, book)].items()
+                if v[0] == period)
+        last = _child(filter_, 'ClavePaginacion')
+        if last is not None:
+            last = _invoice_key(last)
+            keys = [k for k in keys if k > last]
+        page, more = keys[:self.page_size], len(keys) > self.page_size
+
+        response = etree.Element(_qname('siiLRRC',
+                'RespuestaConsultaLRFacturas%s' % kind),
+            nsmap={'siiLRRC': NAMESPACES['siiLRRC'],
+                'sii': NAMESPACES['sii']})
+        self._copy_header(response, header)
+        etree.SubElement(response,
+            _qname('siiLRRC', 'IndicadorPaginacion')).text = (
+            'S' if more else 'N')
+        etree.SubElement(response, _qname('siiLRRC', 'ResultadoConsulta')
+            ).text = 'ConDatos' if page else 'SinDatos'
+        now = datetime.now().strftime(_TIMESTAMP_FMT)
+        registers = self.registers[(titular, book)]
+        for key in page:
+            _, id_factura, invoice = registers[key]
+            register = etree.SubElement(response, _qname('siiLRRC',
+                    'RegistroRespuestaConsultaLRFacturas%s' % kind))
+            copy = etree.SubElement(register, _qname('siiLRRC', 'IDFactura'))
+            for child in id_factura:
+                copy.append(etree.fromstring(etree.tostring(child)))
+            data = etree.SubElement(register, _qname('siiLRRC',
+                    'DatosFacturaEmitida' if book == 'E'
+                    else 'DatosFacturaRecibida'))
+            for child in invoice:
+                data.append(etree.fromstring(etree.tostring(child)))
+            presentation = etree.SubElement(register,
+                _qname('siiLRRC', 'DatosPresentacion'))
+            etree.SubElement(presentation,
+                _qname('sii', 'NIFPresentador')).text = titular
+            etree.SubElement(presentation,
+                _qname('sii', 'TimestampPresentacion')).text = now
+            etree.SubElement(presentation, _qname('sii', 'CSV')).text = (
+                'SI0000000000000000')
+            state = etree.SubElement(register,
+                _qname('siiLRRC', 'EstadoFactura'))
+            etree.SubElement(state,
+                _qname('sii', 'TimestampUltimaModificacion')).text = now
+            etree.SubElement(state, _qname('sii', 'EstadoRegistro')).text = (
+                'Correcta')
+            balance = etree.SubElement(register,
+                _qname('siiLRRC', 'EstadoCuadre'))
+            # Not reconcilable
+            etree.SubElement(balance, _qname('sii', 'EstadoCuadre')).text = '1'
+        return response
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, body = self.server.stand_in.handle(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'JSESSIONID=%s; Path=/' % id(self))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=0, **kwargs):
+    '''
+    Start a stand-in server in a daemon thread.
+    The server has the SIIStandIn as stand_in and its address as url.
+    '''
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.stand_in = SIIStandIn(**kwargs)
+    server.url = 'http://%s:%s/' % server.server_address[:2]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--record-latency', type=float, default=0)
+    parser.add_argument('--reject-ratio', type=float, default=0)
+    parser.add_argument('--fault-ratio', type=float, default=0)
+    parser.add_argument('--fault-code', type=int, default=4102)
+    parser.add_argument('--page-size', type=int, default=10000)
+    parser.add_argument('--seed', nargs=5, action='append', default=[],
+        metavar=('NIF', 'BOOK', 'YEAR', 'PERIOD', 'COUNT'),
+        help='register COUNT invoices to be queried')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), _Handler)
+    server.stand_in = SIIStandIn(latency=args.latency,
+        record_latency=args.record_latency, reject_ratio=args.reject_ratio,
+        fault_ratio=args.fault_ratio, fault_code=args.fault_code,
+        page_size=args.page_size)
+    for nif, book, year, period, count in args.seed:
+        server.stand_in.seed(nif, book, int(year), int(period), int(count))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,66 @@
 # -*- coding: utf-8 -*-
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import io
+import os
+from decimal import Decimal
+from operator import attrgetter
+from types import SimpleNamespace
 import unittest
 import doctest
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import ModuleTestCase
 from trytond.tests.test_tryton import doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
-from trytond.modules.aeat_sii.tools import unaccent
+from trytond.config import config
+from lxml import etree
+from trytond.modules.aeat_sii.tools import (
+    unaccent, SessionIdPlugin, NAMESPACES, dumps_header, loads_header,
+    header_digest, with_header_digest)
+from trytond.modules.aeat_sii.envelope import build_envelope
+from trytond.modules.aeat_sii.service import _QueryResponse
+from trytond.modules.aeat_sii.aeat import (SIIReport, _issued_register,
+    _invoice_key, _issuer_tax_identifier, _pair_response_lines)
+from trytond.modules.aeat_sii.aeat_mapping import (TaxBreakdown,
+    _mapping_environ)
+from requests.models import Response
+from trytond.modules.aeat_sii.tests import sii_server
+
+ENVELOPE = '''<soapenv:Envelope
+    xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+    xmlns:sii="https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/ssii_1_1_bis/fact/ws/SuministroInformacion.xsd">
+  <soapenv:Body>
+    <sii:SuministroLRFacturasEmitidas>
+      <sii:Cabecera>
+        <sii:Titular><sii:NIF>%s</sii:NIF></sii:Titular>
+      </sii:Cabecera>
+    </sii:SuministroLRFacturasEmitidas>
+  </soapenv:Body>
+</soapenv:Envelope>'''
+
+SUBMIT = '''<soapenv:Envelope
+    xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+    xmlns:siiLR="https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/ssii_1_1_bis/fact/ws/SuministroLR.xsd"
+    xmlns:sii="https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/ssii_1_1_bis/fact/ws/SuministroInformacion.xsd">
+  <soapenv:Body>
+    <siiLR:SuministroLRFacturasEmitidas>
+      <sii:Cabecera>
+        <sii:Titular><sii:NIF>B00000000</sii:NIF></sii:Titular>
+      </sii:Cabecera>
+      <siiLR:RegistroLRFacturasEmitidas>
+        <sii:PeriodoLiquidacion>
+          <sii:Ejercicio>2017</sii:Ejercicio><sii:Periodo>01</sii:Periodo>
+        </sii:PeriodoLiquidacion>
+        <siiLR:IDFactura>
+          <sii:IDEmisorFactura><sii:NIF>B00000000</sii:NIF></sii:IDEmisorFactura>
+          <sii:NumSerieFacturaEmisor>%s</sii:NumSerieFacturaEmisor>
+          <sii:FechaExpedicionFacturaEmisor>01-01-2017</sii:FechaExpedicionFacturaEmisor>
+        </siiLR:IDFactura>
+        <siiLR:FacturaExpedida><sii:TipoFactura>F1</sii:TipoFactura></siiLR:FacturaExpedida>
+      </siiLR:RegistroLRFacturasEmitidas>
+    </siiLR:SuministroLRFacturasEmitidas>
+  </soapenv:Body>
+</soapenv:Envelope>'''
 
 
 class AeatSIITestCase(ModuleTestCase):
@@ -23,6 +76,228 @@ class AeatSIITestCase(ModuleTestCase):
                 ]:
             self.assertEqual(unaccent(value), result)
 
+    def test_session_id_plugin(self):
+        plugin = SessionIdPlugin()
+        first = etree.fromstring(ENVELOPE % 'B00000000')
+        other = etree.fromstring(ENVELOPE % 'B11111111')
+
+        _, headers = plugin.egress(first, {}, None, None)
+        self.assertNotIn('Cookie', headers)
+        plugin.ingress(first, {'Set-Cookie': 'JSESSIONID=abc; Path=/'}, None)
+        _, headers = plugin.egress(first, {}, None, None)
+        self.assertEqual(headers['Cookie'], 'JSESSIONID=abc')
+        _, headers = plugin.egress(other, {}, None, None)
+        self.assertNotIn('Cookie', headers)
+
+        plugin.timeout = -1
+        _, headers = plugin.egress(first, {}, None, None)
+        self.assertNotIn('Cookie', headers)
+        self.assertEqual(plugin.stats(),
+            {'created': 1, 'reused': 1, 'expired': 1})
+
+    def test_sii_server(self):
+        stand_in = sii_server.SIIStandIn(page_size=1)
+        stand_in.seed('B00000000', 'E', 2017, 1, 2)
+
+        status, content = stand_in.handle((SUBMIT % 'A1').encode('utf-8'))
+        self.assertEqual(status, 200)
+        self.assertEqual(etree.fromstring(content).xpath(
+                'string(//*[local-name()="EstadoEnvio"])'), 'Correcto')
+        status, content = stand_in.handle((SUBMIT % 'A1').encode('utf-8'))
+        self.assertEqual(etree.fromstring(content).xpath(
+                'string(//*[local-name()="CodigoErrorRegistro"])'), '3000')
+
+        query = (SUBMIT % 'A1').replace(
+            'SuministroLR', 'ConsultaLR').replace(
+            'RegistroLRFacturasEmitidas', 'FiltroConsulta')
+        status, content = stand_in.handle(query.encode('utf-8'))
+        response = etree.fromstring(content)
+        self.assertEqual(response.xpath(
+                'string(//*[local-name()="IndicadorPaginacion"])'), 'S')
+        self.assertEqual(len(response.xpath(
+                    '//*[local-name()="NumSerieFacturaEmisor"]')), 1)
+
+        stand_in.fault_ratio = 1
+        status, content = stand_in.handle((SUBMIT % 'A2').encode('utf-8'))
+        self.assertEqual(status, 500)
+
+    def test_build_envelope(self):
+        envelope = build_envelope('AnulacionLRFacturasEmitidas', {
+                'TipoComunicacion': 'A0',
+                'IDVersionSii': '1.1',
+                'Titular': {'NIF': 'B00000000', 'NombreRazon': 'A & B'},
+                }, [{
+                    'IDFactura': {
+                        'FechaExpedicionFacturaEmisor': '01-01-2017',
+                        'IDEmisorFactura': {'NIF': 'B00000000'},
+                        'NumSerieFacturaEmisor': 'A1',
+                        },
+                    'PeriodoLiquidacion': {'Periodo': '01', 'Ejercicio': 2017},
+                    }])
+        request, = envelope[0]
+        self.assertEqual(request.tag, '{%s}AnulacionLRFacturasEmitidas'
+            % NAMESPACES['siiLR'])
+        header, register = request
+        self.assertEqual([etree.QName(e).localname for e in header],
+            ['IDVersionSii', 'Titular', 'TipoComunicacion'])
+        self.assertEqual(header[1][0].text, 'A & B')
+        self.assertEqual([e.tag for e in register], [
+                '{%s}PeriodoLiquidacion' % NAMESPACES['sii'],
+                '{%s}IDFactura' % NAMESPACES['siiLR'],
+                ])
+        self.assertEqual([e.text for e in register[0]], ['2017', '01'])
+        with self.assertRaises(TypeError):
+            build_envelope('AnulacionLRFacturasEmitidas', {'Unknown': 1}, [])
+
+    def test_query_response(self):
+        stand_in = sii_server.SIIStandIn(page_size=2)
+        stand_in.seed('B00000000', 'E', 2017, 1, 3)
+        query = (SUBMIT % 'A1').replace(
+            'SuministroLR', 'ConsultaLR').replace(
+            'RegistroLRFacturasEmitidas', 'FiltroConsulta')
+        _, content = stand_in.handle(query.encode('utf-8'))
+        response = Response()
+        response.raw = io.BytesIO(content)
+
+        envelopes = []
+        res = _QueryResponse(response,
+            'RegistroRespuestaConsultaLRFacturasEmitidas',
+            ingress=envelopes.append)
+        lines = [_issued_register(reg) for reg in res]
+        self.assertEqual([l['serial_number'] for l in lines],
+            ['SEED201701/000000', 'SEED201701/000001'])
+        self.assertEqual(lines[0]['counterpart_id'], 'B00000000')
+        self.assertEqual(lines[0]['balance_state'], '1')
+        taxes, = lines[0]['taxes'][0][1]
+        self.assertEqual(taxes['amount'], Decimal('21.00'))
+        self.assertEqual(res.pagination, 'S')
+        self.assertEqual(res.last_invoice['NumSerieFacturaEmisor'],
+            'SEED201701/000001')
+        envelope, = envelopes
+        self.assertEqual(len(envelope.xpath('//*[local-name()='
+                    '"RegistroRespuestaConsultaLRFacturasEmitidas"]')), 1)
+        self.assertEqual(envelope.xpath('//*[local-name()="Cabecera"]'
+                '/*[local-name()="Titular"]/*[local-name()="NIF"]/text()'),
+            ['B00000000'])
+
+    def test_header_storage(self):
+        header = {
+            'PeriodoLiquidacion': {'Ejercicio': 2017, 'Periodo': '01'},
+            'IDFactura': {
+                'IDEmisorFactura': {'NIF': 'B00000000'},
+                'NumSerieFacturaEmisor': 'FV/1',
+                'FechaExpedicionFacturaEmisor': '01-01-2017',
+                },
+            }
+        value = dumps_header(header)
+        self.assertEqual(loads_header(value), header)
+        self.assertEqual(loads_header(str(header)), header)
+        self.assertEqual(dumps_header(loads_header(str(header))), value)
+        self.assertEqual(header_digest(value),
+            header_digest(dumps_header(dict(reversed(list(header.items()))))))
+        self.assertIsNone(header_digest(''))
+        self.assertEqual(with_header_digest({'sii_header': str(header)}), {
+                'sii_header': value,
+                'sii_header_digest': header_digest(value),
+                })
+        self.assertEqual(with_header_digest({'state': 'Correcto'}),
+            {'state': 'Correcto'})
+
+    def test_invoice_key(self):
+        request = {
+            'IDEmisorFactura': {'NIF': 'B00000000'},
+            'NumSerieFacturaEmisor': 'FV/1',
+            'FechaExpedicionFacturaEmisor': '01-01-2017',
+            }
+        response = dict(request, IDEmisorFactura={
+                'NombreRazon': 'EMPRESA', 'NIF': 'B00000000'})
+        self.assertEqual(_invoice_key(request), _invoice_key(response))
+        other = dict(request, IDEmisorFactura={'IDOtro': {
+                    'CodigoPais': 'FR', 'IDType': '02', 'ID': 'FR1'}})
+        self.assertEqual(_invoice_key(other),
+            ('FR1', 'FV/1', '01-01-2017'))
+
+    def test_pair_response_lines(self):
+        def invoice_id(number, issuer='FR1'):
+            return {
+                'IDEmisorFactura': {'IDOtro': {'ID': issuer}},
+                'NumSerieFacturaEmisor': number,
+                'FechaExpedicionFacturaEmisor': '01-01-2017',
+                }
+
+        index = {}
+        for line, number in [(1, 'F1'), (2, 'F1'), (3, 'F2')]:
+            index.setdefault(_invoice_key(invoice_id(number)), []).append(
+                line)
+        response = [{'IDFactura': invoice_id(n)}
+            for n in ['F2', 'F1', 'F3', 'F1']]
+        self.assertEqual(
+            [l for l, _ in _pair_response_lines(index, response)], [3, 1, 2])
+
+    def test_issuer_tax_identifier(self):
+        values = {'issuer_vat_number': 'b00000000'}
+        self.assertEqual(_issuer_tax_identifier(values, None), 'ESB00000000')
+        values = {'issuer_vat_number': 'FR 12345'}
+        self.assertEqual(_issuer_tax_identifier(values, '02'), 'FR12345')
+        self.assertEqual(_issuer_tax_identifier(values, '04'), None)
+
+    def test_send_waves(self):
+        def report(operation_type, *invoices):
+            return SimpleNamespace(operation_type=operation_type,
+                lines=[SimpleNamespace(invoice=SimpleNamespace(id=i))
+                    for i in invoices])
+
+        delete1, delete2 = report('D0', 1), report('D0', 2)
+        register = report('A0', 1, 2, 3)
+        amend = report('A1', 4)
+        other = report('A0', 3)
+        self.assertEqual(
+            SIIReport._send_waves([delete1, delete2, register, amend, other]),
+            [[delete1, delete2, amend], [register], [other]])
+
+    def test_mapping_environ(self):
+        environ = _mapping_environ()
+        self.assertEqual(environ['TRYTOND_DATABASE__URI'],
+            config.get('database', 'uri'))
+        self.assertTrue(all(k.startswith('TRYTOND_')
+                for k in set(environ) - set(os.environ)))
+
+    def test_tax_breakdown(self):
+        def tax(id, surcharge=None, **values):
+            values.setdefault('recargo_equivalencia', False)
+            return SimpleNamespace(id=id, parent=None, tax_used=True,
+                invoice_used=True, recargo_equivalencia_related_tax=surcharge,
+                **values)
+
+        def invoice_tax(id, tax, base, amount):
+            return SimpleNamespace(id=id, tax=tax, base=Decimal(base),
+                company_base=Decimal(base), company_amount=Decimal(amount))
+
+        surcharge = tax(1, recargo_equivalencia=True)
+        vat = tax(2, surcharge=surcharge)
+        exempt = tax(3)
+        not_subject = SimpleNamespace(sii_exemption_cause='NotSubject',
+            sii_issued_key='08')
+        taxes = [
+            invoice_tax(10, vat, '100', '21'),
+            invoice_tax(11, surcharge, '-50', '-2.6'),
+            invoice_tax(12, surcharge, '100', '5.2'),
+            invoice_tax(13, exempt, '20', '0'),
+            ]
+        invoice = SimpleNamespace(id=1, taxes=taxes, lines=[
+                SimpleNamespace(amount=Decimal(30), taxes=[not_subject])])
+        mapper = SimpleNamespace(get_tax_base=attrgetter('company_base'),
+            get_tax_amount=attrgetter('company_amount'),
+            tax_amount=attrgetter('company_amount'))
+
+        breakdown = TaxBreakdown(mapper, invoice)
+        self.assertEqual([t.id for t in breakdown.taxes], [10, 13])
+        self.assertEqual(breakdown.total_taxes, breakdown.taxes)
+        self.assertEqual(breakdown.surcharges, {10: taxes[2]})
+        self.assertEqual(breakdown.total, Decimal('146.2'))
+        self.assertEqual(breakdown.not_subject, Decimal(30))
+        self.assertEqual(breakdown.location_rules, Decimal(30))
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
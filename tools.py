@@ -1,16 +1,39 @@
 # -*- coding: utf-8 -*-
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import hashlib
+import json
+import re
+import time
 import unicodedata
-from logging import getLogger
+from ast import literal_eval
+from logging import getLogger, DEBUG
+from threading import Lock
 from lxml import etree
+from sql import Null
+from sql.conditionals import Case
 from zeep import Plugin
 
+from trytond.model import Model
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
 src_chars = "/*+?Â¿!$[]{}@#`^:;<>=~%\\"
 dst_chars = "________________________"
 
 _logger = getLogger(__name__)
 
+SOAP_NAMESPACE = 'http://schemas.xmlsoap.org/soap/envelope/'
+_SII_NAMESPACE = ('https://www2.agenciatributaria.gob.es/static_files/common/'
+    'internet/dep/aplicaciones/es/aeat/ssii_1_1_bis/fact/ws/%s.xsd')
+NAMESPACES = {
+    'sii': _SII_NAMESPACE % 'SuministroInformacion',
+    'siiLR': _SII_NAMESPACE % 'SuministroLR',
+    'siiR': _SII_NAMESPACE % 'RespuestaSuministro',
+    'siiLRC': _SII_NAMESPACE % 'ConsultaLR',
+    'siiLRRC': _SII_NAMESPACE % 'RespuestaConsultaLR',
+    }
+
 
 def normalize(text):
     if isinstance(text, str):
@@ -62,21 +85,254 @@ def fixed_value(value):
     return _FixedValue(value)
 
 
+def dumps_header(header):
+    "Return the canonical JSON of an SII header"
+    return json.dumps(header, sort_keys=True, separators=(',', ':'),
+        default=str)
+
+
+def loads_header(value):
+    "Return the SII header stored as JSON or as a Python literal"
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        # Stored by older versions
+        return literal_eval(value)
+
+
+def header_digest(value):
+    "Return the digest of a stored SII header"
+    if value:
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def header_values(value):
+    "Return the values that store value as the SII header with its digest"
+    if value:
+        try:
+            value = dumps_header(loads_header(value))
+        except (ValueError, SyntaxError):
+            # Not a header, it is kept as written
+            pass
+    return {
+        'sii_header': value,
+        'sii_header_digest': header_digest(value),
+        }
+
+
+def with_header_digest(values):
+    "Return the written values with the digest of their SII header if any"
+    if 'sii_header' in values:
+        values = values.copy()
+        values.update(header_values(values['sii_header']))
+    return values
+
+
+def migrate_headers(cursor, table):
+    "Store the SII headers of table as canonical JSON with their digest"
+    cursor.execute(*table.select(table.id,
+            where=(table.sii_header != Null)
+            & (table.sii_header_digest == Null)))
+    ids = [i for i, in cursor.fetchall()]
+    # Each row takes two parameters per column and its id
+    for sub_ids in grouped_slice(ids, Transaction().database.IN_MAX // 5):
+        sub_ids = list(sub_ids)
+        cursor.execute(*table.select(table.id, table.sii_header,
+                where=table.id.in_(sub_ids)))
+        headers, digests = [], []
+        for id_, header in cursor.fetchall():
+            values = header_values(header)
+            headers.append((table.id == id_, values['sii_header']))
+            digests.append((table.id == id_, values['sii_header_digest']))
+        cursor.execute(*table.update(
+                [table.sii_header, table.sii_header_digest],
+                [Case(*headers), Case(*digests)],
+                where=table.id.in_(sub_ids)))
+
+
+def prefetch(records, paths):
+    '''
+    Read the dotted field paths of records level by level.
+
+    records must be browsed together so the ORM reads each level for the
+    whole block at once instead of once per record, later accesses are then
+    served from the record caches.
+    '''
+    _prefetch(records, _path_tree(paths))
+
+
+def _path_tree(paths):
+    tree = {}
+    for path in paths:
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def _prefetch(records, tree):
+    for name, subtree in tree.items():
+        related = []
+        for record in records:
+            # Fields of optional modules may be missing
+            value = getattr(record, name, None)
+            if isinstance(value, tuple):
+                related.extend(value)
+            elif value is not None:
+                related.append(value)
+        if subtree and related:
+            _prefetch(related, subtree)
+
+
+def related_records(record, paths):
+    "Return the records reached from record by the dotted field paths"
+    related = set()
+    _related_records(record, _path_tree(paths), related)
+    return related
+
+
+def _related_records(record, tree, related):
+    for name, subtree in tree.items():
+        # Fields of optional modules may be missing
+        value = getattr(record, name, None)
+        for value in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(value, Model):
+                related.add(value)
+                if subtree:
+                    _related_records(value, subtree, related)
+
+
+class QueryCounter(object):
+    '''
+    Count the SQL queries executed by the transaction inside the block.
+
+    Only the PostgreSQL and SQLite backends are supported, count stays None
+    on the others or when active is False.
+    '''
+
+    def __init__(self, active=True):
+        self.active = active
+        self.count = None
+        self._restore = None
+
+    def __enter__(self):
+        if not self.active:
+            return self
+        connection = Transaction().connection
+        if hasattr(connection, 'cursor_factory'):
+            self.count = 0
+            factory = connection.cursor_factory
+            counter = self
+
+            class CountingCursor(factory):
+                def execute(self, *args, **kwargs):
+                    counter.count += 1
+                    return super(CountingCursor, self).execute(
+                        *args, **kwargs)
+
+            connection.cursor_factory = CountingCursor
+
+            def restore():
+                connection.cursor_factory = factory
+            self._restore = restore
+        elif hasattr(connection, 'set_trace_callback'):
+            self.count = 0
+
+            def trace(statement):
+                self.count += 1
+                if backend_logger.isEnabledFor(DEBUG):
+                    backend_logger.debug(statement)
+            backend_logger = getLogger('trytond.backend.sqlite.database')
+            connection.set_trace_callback(trace)
+
+            def restore():
+                connection.set_trace_callback(backend_logger.debug
+                    if backend_logger.isEnabledFor(DEBUG) else None)
+            self._restore = restore
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._restore:
+            self._restore()
+            self._restore = None
+
+
 class LoggingPlugin(Plugin):
 
-    def ingress(self, envelope, http_headers, operation):
+    def _log(self, envelope, http_headers, operation):
+        if not _logger.isEnabledFor(DEBUG):
+            return
         _logger.debug('http_headers: %s', http_headers)
         _logger.debug('operation: %s', operation)
         _logger.debug('envelope: %s', etree.tostring(
             envelope, pretty_print=True))
+
+    def ingress(self, envelope, http_headers, operation):
+        self._log(envelope, http_headers, operation)
         return envelope, http_headers
 
     def egress(self, envelope, http_headers, operation, binding_options):
-        _logger.debug('http_headers: %s', http_headers)
-        _logger.debug('operation: %s', operation)
-        _logger.debug('envelope: %s', etree.tostring(
-            envelope, pretty_print=True))
+        self._log(envelope, http_headers, operation)
         return envelope, http_headers
 
 
-# TODO: JSESSIONID Plugin
+class SessionIdPlugin(Plugin):
+    '''
+    Replay the AEAT session identifier between consecutive calls of the same
+    titular as recommended by the AEAT.
+    '''
+    cookie = 'JSESSIONID'
+    _titular_path = etree.XPath('*[local-name()="Body"]/*'
+        '/*[local-name()="Cabecera"]/*[local-name()="Titular"]'
+        '/*[local-name()="NIF"]/text()')
+
+    def __init__(self, timeout=900):
+        self.timeout = timeout
+        self._sessions = {}
+        self._lock = Lock()
+        self._set_cookie = re.compile(r'%s=([^;,\s]+)' % self.cookie)
+        self.created = self.reused = self.expired = 0
+
+    def _titular(self, envelope):
+        nif = self._titular_path(envelope)
+        return nif[0] if nif else None
+
+    def egress(self, envelope, http_headers, operation, binding_options):
+        titular = self._titular(envelope)
+        if not titular:
+            return envelope, http_headers
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(titular)
+            if session and now - session[1] > self.timeout:
+                del self._sessions[titular]
+                self.expired += 1
+                session = None
+            if session:
+                self.reused += 1
+                http_headers['Cookie'] = '%s=%s' % (self.cookie, session[0])
+        return envelope, http_headers
+
+    def ingress(self, envelope, http_headers, operation):
+        titular = self._titular(envelope)
+        if not titular:
+            return envelope, http_headers
+        match = self._set_cookie.search(http_headers.get('Set-Cookie', ''))
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(titular)
+            if match and (not session or session[0] != match.group(1)):
+                self._sessions[titular] = [match.group(1), now]
+                self.created += 1
+            elif session:
+                session[1] = now
+        return envelope, http_headers
+
+    def stats(self):
+        return {
+            'created': self.created,
+            'reused': self.reused,
+            'expired': self.expired,
+            }